@@ -87,19 +87,36 @@ from SpiderKeeper.app.spider.model import *
 def init_database():
     db.init_app(app)
     db.create_all()
+    from SpiderKeeper.app.spider.model import init_title_index, check_indexes
+    check_indexes()
+    init_title_index()
 
 
 # regist spider service proxy
 from SpiderKeeper.app.proxy.spiderctrl import SpiderAgent
 from SpiderKeeper.app.proxy.contrib.scrapy import ScrapydProxy
+from SpiderKeeper.app.proxy.contrib.scrapy_async import AsyncScrapydProxy
+from SpiderKeeper.app.util.http import configure_clients
 
 agent = SpiderAgent()
 
 
+def init_http_client():
+    configure_clients(connect_timeout=app.config.get('HTTP_CONNECT_TIMEOUT'),
+                      read_timeout=app.config.get('HTTP_READ_TIMEOUT'),
+                      pool_maxsize=app.config.get('HTTP_POOL_MAXSIZE'),
+                      failure_threshold=app.config.get('CIRCUIT_FAILURE_THRESHOLD'),
+                      backoff_base=app.config.get('CIRCUIT_BACKOFF_BASE'),
+                      backoff_max=app.config.get('CIRCUIT_BACKOFF_MAX'))
+
+
 def regist_server():
     if app.config.get('SERVER_TYPE') == 'scrapyd':
         for server in app.config.get("SERVERS"):
             agent.regist(ScrapydProxy(server))
+    if app.config.get('SERVER_TYPE') == 'scrapyd-async':
+        for server in app.config.get("SERVERS"):
+            agent.regist(AsyncScrapydProxy(server))
 
 
 from SpiderKeeper.app.spider.controller import api_spider_bp
@@ -109,13 +126,24 @@ app.register_blueprint(api_spider_bp)
 
 # start sync job status scheduler
 from SpiderKeeper.app.schedulers.common import sync_job_execution_status_job, sync_spiders, \
-    reload_runnable_spider_job_execution, sync_job_instance_status, web_monitor
+    reload_runnable_spider_job_execution, sync_job_instance_status, web_monitor, sync_daemon_status, sync_eggs, \
+    mirror_job_logs, ingest_job_stats, roll_up_video_counts
 
-scheduler.add_job(sync_job_execution_status_job, 'interval', seconds=5, id='sys_sync_status')
+scheduler.add_job(sync_job_execution_status_job, 'interval', seconds=app.config.get('SYNC_JOB_STATUS_INTERVAL', 5),
+                  id='sys_sync_status')
 scheduler.add_job(sync_job_instance_status, 'interval', seconds=60, id='sys_sync_job_instance_status')
 scheduler.add_job(sync_spiders, 'interval', seconds=10, id='sys_sync_spiders')
 scheduler.add_job(reload_runnable_spider_job_execution, 'interval', seconds=30, id='sys_reload_job')
 scheduler.add_job(web_monitor, 'interval', seconds=360, id='target_web_monitor_log')
+scheduler.add_job(sync_daemon_status, 'interval', seconds=app.config.get('DAEMON_STATUS_INTERVAL', 10),
+                  id='sys_sync_daemon_status')
+scheduler.add_job(sync_eggs, 'interval', seconds=app.config.get('EGG_SYNC_INTERVAL', 60), id='sys_sync_eggs')
+scheduler.add_job(mirror_job_logs, 'interval', seconds=app.config.get('LOG_MIRROR_INTERVAL', 60),
+                  id='sys_mirror_job_logs')
+scheduler.add_job(ingest_job_stats, 'interval', seconds=app.config.get('LOG_MIRROR_INTERVAL', 60),
+                  id='sys_ingest_job_stats')
+scheduler.add_job(roll_up_video_counts, 'interval', seconds=app.config.get('VIDEO_ROLLUP_INTERVAL', 60),
+                  id='sys_roll_up_video_counts')
 
 
 def start_scheduler():
@@ -129,6 +157,7 @@ def init_basic_auth():
 
 def initialize():
     init_database()
+    init_http_client()
     regist_server()
     start_scheduler()
     init_basic_auth()
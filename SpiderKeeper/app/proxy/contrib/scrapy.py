@@ -1,10 +1,30 @@
 import datetime, time
-
-import requests
+import logging
+import re
 
 from SpiderKeeper.app.proxy.spiderctrl import SpiderServiceProxy
 from SpiderKeeper.app.spider.model import SpiderStatus, Project, SpiderInstance
-from SpiderKeeper.app.util.http import request
+from SpiderKeeper.app.util.http import request, get_client, is_available, MultipartFileStream
+
+
+class ScrapydJobInfo(object):
+    '''
+    job entry of listjobs.json, start_time and end_time are parsed on first access
+    '''
+    time_format = '%Y-%m-%d %H:%M:%S.%f'
+
+    def __init__(self, item):
+        self.id = item['id']
+        self._item = item
+        self._times = {}
+
+    def __getitem__(self, key):
+        if key == 'id':
+            return self.id
+        if key not in self._times:
+            value = self._item.get(key)
+            self._times[key] = datetime.datetime.strptime(value, self.time_format) if value else None
+        return self._times[key]
 
 
 class ScrapydProxy(SpiderServiceProxy):
@@ -14,13 +34,20 @@ class ScrapydProxy(SpiderServiceProxy):
             SpiderStatus.RUNNING: 'running',
             SpiderStatus.FINISHED: 'finished'
         }
+        # acknowledged job status of each project: {project_name: {job_id: SpiderStatus}}
+        self._known_jobs = {}
+        # spider names of each deployed egg: {(project_name, version): [spider_name]}
+        self._spider_names = {}
         super(ScrapydProxy, self).__init__(server)
 
     def _scrapyd_url(self):
         return self.server
 
-    def get_project_list(self):
-        data = request("get", self._scrapyd_url() + "/listprojects.json", return_type="json")
+    @property
+    def available(self):
+        return is_available(self._scrapyd_url())
+
+    def _parse_project_list(self, data):
         result = []
         if data:
             for project_name in data['projects']:
@@ -29,40 +56,108 @@ class ScrapydProxy(SpiderServiceProxy):
                 result.append(project)
         return result
 
+    def get_project_list(self):
+        data = request("get", self._scrapyd_url() + "/listprojects.json", return_type="json")
+        return self._parse_project_list(data)
+
     def delete_project(self, project_name):
         post_data = dict(project=project_name)
         data = request("post", self._scrapyd_url() + "/delproject.json", data=post_data, return_type="json")
         return True if data and data['status'] == 'ok' else False
 
-    def get_spider_list(self, project_name):
-        data = request("get", self._scrapyd_url() + "/listspiders.json?project=%s" % project_name,
+    def get_project_versions(self, project_name):
+        data = request("get", self._scrapyd_url() + "/listversions.json?project=%s" % project_name,
                        return_type="json")
+        return data['versions'] if data and data['status'] == 'ok' else None
+
+    def _cache_spider_names(self, project_name, version, data):
+        if not data or data['status'] != 'ok':
+            return None
+        # a project only runs its latest version, older entries are dead
+        for key in [key for key in self._spider_names if key[0] == project_name]:
+            del self._spider_names[key]
+        self._spider_names[(project_name, version)] = data['spiders']
+        return data['spiders']
+
+    def _parse_spider_list(self, spider_names):
+        if spider_names is None:
+            return None
         result = []
-        if data and data['status'] == 'ok':
-            for spider_name in data['spiders']:
-                spider_instance = SpiderInstance()
-                spider_instance.spider_name = spider_name
-                result.append(spider_instance)
+        for spider_name in spider_names:
+            spider_instance = SpiderInstance()
+            spider_instance.spider_name = spider_name
+            result.append(spider_instance)
         return result
 
+    def get_spider_list(self, project_name):
+        '''
+        spiders of the latest egg version, listspiders.json only runs when the version changes
+        :param project_name:
+        :return: [SpiderInstance], None if the daemon could not be reached
+        '''
+        versions = self.get_project_versions(project_name)
+        if not versions:
+            return versions
+        spider_names = self._spider_names.get((project_name, versions[-1]))
+        if spider_names is None:
+            data = request("get", self._scrapyd_url() + "/listspiders.json?project=%s&_version=%s" % (
+                project_name, versions[-1]), return_type="json")
+            spider_names = self._cache_spider_names(project_name, versions[-1], data)
+        return self._parse_spider_list(spider_names)
+
+    def _parse_daemon_status(self, data):
+        if not data or data['status'] != 'ok':
+            return None
+        return dict(running=int(data.get('running', 0)),
+                    pending=int(data.get('pending', 0)),
+                    finished=int(data.get('finished', 0)),
+                    node_name=data.get('node_name'))
+
     def get_daemon_status(self):
-        pass
+        data = request("get", self._scrapyd_url() + "/daemonstatus.json", return_type="json")
+        return self._parse_daemon_status(data)
 
-    def get_job_list(self, project_name, spider_status=None):
+    def _list_jobs(self, project_name):
         data = request("get", self._scrapyd_url() + "/listjobs.json?project=%s" % project_name,
                        return_type="json")
+        return data if data and data['status'] == 'ok' else None
+
+    def _parse_job_list(self, data, spider_status=None):
         result = {SpiderStatus.PENDING: [], SpiderStatus.RUNNING: [], SpiderStatus.FINISHED: []}
-        if data and data['status'] == 'ok':
+        if data:
             for _status in self.spider_status_name_dict.keys():
                 for item in data[self.spider_status_name_dict[_status]]:
-                    start_time, end_time = None, None
-                    if item.get('start_time'):
-                        start_time = datetime.datetime.strptime(item['start_time'], '%Y-%m-%d %H:%M:%S.%f')
-                    if item.get('end_time'):
-                        end_time = datetime.datetime.strptime(item['end_time'], '%Y-%m-%d %H:%M:%S.%f')
-                    result[_status].append(dict(id=item['id'], start_time=start_time, end_time=end_time))
+                    result[_status].append(ScrapydJobInfo(item))
         return result if not spider_status else result[spider_status]
 
+    def get_job_list(self, project_name, spider_status=None):
+        return self._parse_job_list(self._list_jobs(project_name), spider_status)
+
+    def _parse_job_changes(self, project_name, data):
+        if not data:
+            return None
+        known_jobs = self._known_jobs.get(project_name, {})
+        listed_job_ids = set()
+        result = {SpiderStatus.PENDING: [], SpiderStatus.RUNNING: [], SpiderStatus.FINISHED: []}
+        for _status in (SpiderStatus.RUNNING, SpiderStatus.FINISHED):
+            for item in data[self.spider_status_name_dict[_status]]:
+                listed_job_ids.add(item['id'])
+                if known_jobs.get(item['id']) != _status:
+                    result[_status].append(ScrapydJobInfo(item))
+        # scrapyd dropped these jobs from its history, they will not be listed again
+        for job_id in set(known_jobs).difference(listed_job_ids):
+            del known_jobs[job_id]
+        return result
+
+    def get_job_changes(self, project_name):
+        return self._parse_job_changes(project_name, self._list_jobs(project_name))
+
+    def ack_job_changes(self, project_name, job_ids):
+        known_jobs = self._known_jobs.setdefault(project_name, {})
+        for _status, _job_ids in job_ids.items():
+            for job_id in _job_ids:
+                known_jobs[job_id] = _status
+
     def start_spider(self, project_name, spider_name, arguments):
         post_data = dict(project=project_name, spider=spider_name)
         post_data.update(arguments)
@@ -74,15 +169,66 @@ class ScrapydProxy(SpiderServiceProxy):
         data = request("post", self._scrapyd_url() + "/cancel.json", data=post_data, return_type="json")
         return data != None
 
-    def deploy(self, project_name, file_path):
-        with open(file_path, 'rb') as f:
-            eggdata = f.read()
-        res = requests.post(self._scrapyd_url() + '/addversion.json', data={
-            'project': project_name,
-            'version': int(time.time()),
-            'egg': eggdata,
-        })
-        return res.text if res.status_code == 200 else None
+    def deploy(self, project_name, file_path, version=None):
+        '''
+        upload an egg, the file is streamed from disk
+        :param project_name:
+        :param file_path:
+        :param version: egg version, every daemon should get the same one
+        :return: addversion.json result, None on failure
+        '''
+        body = MultipartFileStream(dict(project=project_name, version=version or int(time.time())), 'egg', file_path)
+        try:
+            res = get_client(self._scrapyd_url()).request('post', self._scrapyd_url() + '/addversion.json', data=body,
+                                                          headers={'Content-Type': body.content_type})
+            data = res.json() if res.status_code == 200 else None
+        except Exception as e:
+            logging.warning('deploy %s to %s failed %s' % (project_name, self.server, str(e)))
+            return None
+        finally:
+            body.close()
+        return data if data and data['status'] == 'ok' else None
 
     def log_url(self, project_name, spider_name, job_id):
         return self._scrapyd_url() + '/logs/%s/%s/%s.log' % (project_name, spider_name, job_id)
+
+    def read_log(self, project_name, spider_name, job_id, offset, length=None):
+        '''
+        read part of a job log with an http range request
+        :param offset: first byte, negative to read the last -offset bytes
+        :param length: max bytes from offset, None to the end of the log
+        :return: dict(data, offset, next_offset, size), None if the daemon has no such log
+        :raise IOError: the daemon could not be reached or failed, the log may still be there
+        '''
+        url = self.log_url(project_name, spider_name, job_id)
+        if offset < 0:
+            byte_range = 'bytes=-%d' % -offset
+        elif length:
+            byte_range = 'bytes=%d-%d' % (offset, offset + length - 1)
+        else:
+            byte_range = 'bytes=%d-' % offset
+        try:
+            res = get_client(url).request('get', url, headers={'Range': byte_range})
+        except Exception as e:
+            raise IOError('read log %s failed %s' % (url, str(e)))
+        if res.status_code in (404, 410):
+            return None
+        if res.status_code == 206:
+            match = re.match(r'bytes (\d+)-(\d+)/(\d+|\*)', res.headers.get('Content-Range', ''))
+            if match:
+                start, end = int(match.group(1)), int(match.group(2)) + 1
+                size = end if match.group(3) == '*' else int(match.group(3))
+                return dict(data=res.content, offset=start, next_offset=end, size=size)
+        elif res.status_code == 416:
+            # nothing at or after offset, e.g. no new lines since the last read
+            match = re.match(r'bytes \*/(\d+)', res.headers.get('Content-Range', ''))
+            size = int(match.group(1)) if match else max(offset, 0)
+            start = min(max(offset, 0), size)
+            return dict(data=b'', offset=start, next_offset=start, size=size)
+        if res.status_code != 200:
+            raise IOError('read log %s failed, status %s' % (url, res.status_code))
+        # the daemon ignored the range and sent the whole log
+        size = len(res.content)
+        start = max(size + offset, 0) if offset < 0 else min(offset, size)
+        end = min(start + length, size) if length and offset >= 0 else size
+        return dict(data=res.content[start:end], offset=start, next_offset=end, size=size)
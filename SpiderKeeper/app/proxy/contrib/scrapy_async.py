@@ -0,0 +1,130 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+
+import aiohttp
+
+from SpiderKeeper.app.proxy.contrib.scrapy import ScrapydProxy
+from SpiderKeeper.app.util.http import get_client, RETRY_BACKOFF_BASE, RETRY_BACKOFF_MAX
+
+
+class AsyncScrapydProxy(ScrapydProxy):
+    '''
+    scrapyd proxy whose service calls are coroutines, SpiderAgent runs them on its event loop
+    '''
+
+    def __init__(self, server):
+        super(AsyncScrapydProxy, self).__init__(server)
+        # created on the agent event loop by the first request
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            client = get_client(self._scrapyd_url())
+            connect_timeout, read_timeout = client.timeout
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=client.pool_maxsize),
+                timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout))
+        return self._session
+
+    async def _request(self, request_type, url, data=None, retry_times=5):
+        '''
+        async twin of util.http.request, shares the daemon's circuit breaker and counters
+        :param request_type: get/post
+        :param url:
+        :param data:
+        :param retry_times:
+        :return: json obj
+        '''
+        client = get_client(url)
+        for i in range(retry_times):
+            if i:
+                await asyncio.sleep(random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** (i - 1))))
+            if not client.breaker.allow_request():
+                logging.warning('request skipped circuit open for %s' % client.base_url)
+                return None
+            start = time.time()
+            try:
+                async with self._get_session().request(request_type, url, data=data) as res:
+                    body = await res.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                client.record(time.time() - start, error=True)
+                client.breaker.record_failure()
+                # a post is sent again only if it never reached the daemon, as in util.http.request_post
+                if request_type == 'post' and not isinstance(e, aiohttp.ClientConnectorError):
+                    logging.warning('request error %s %s' % (url, str(e)))
+                    return None
+                logging.warning('request error retry %s' % url)
+                continue
+            client.record(time.time() - start)
+            if res.status >= 500:
+                client.breaker.record_failure()
+                return None
+            client.breaker.record_success()
+            try:
+                return json.loads(body.decode('utf8'))
+            except Exception as e:
+                logging.warning('parse json error %s' % str(e))
+                return None
+
+    async def get_project_list(self):
+        data = await self._request("get", self._scrapyd_url() + "/listprojects.json")
+        return self._parse_project_list(data)
+
+    async def delete_project(self, project_name):
+        post_data = dict(project=project_name)
+        data = await self._request("post", self._scrapyd_url() + "/delproject.json", data=post_data)
+        return True if data and data['status'] == 'ok' else False
+
+    async def get_project_versions(self, project_name):
+        data = await self._request("get", self._scrapyd_url() + "/listversions.json?project=%s" % project_name)
+        return data['versions'] if data and data['status'] == 'ok' else None
+
+    async def get_spider_list(self, project_name):
+        versions = await self.get_project_versions(project_name)
+        if not versions:
+            return versions
+        spider_names = self._spider_names.get((project_name, versions[-1]))
+        if spider_names is None:
+            data = await self._request("get", self._scrapyd_url() + "/listspiders.json?project=%s&_version=%s" % (
+                project_name, versions[-1]))
+            spider_names = self._cache_spider_names(project_name, versions[-1], data)
+        return self._parse_spider_list(spider_names)
+
+    async def get_daemon_status(self):
+        data = await self._request("get", self._scrapyd_url() + "/daemonstatus.json")
+        return self._parse_daemon_status(data)
+
+    async def _list_jobs(self, project_name):
+        data = await self._request("get", self._scrapyd_url() + "/listjobs.json?project=%s" % project_name)
+        return data if data and data['status'] == 'ok' else None
+
+    async def get_job_list(self, project_name, spider_status=None):
+        return self._parse_job_list(await self._list_jobs(project_name), spider_status)
+
+    async def get_job_changes(self, project_name):
+        return self._parse_job_changes(project_name, await self._list_jobs(project_name))
+
+    async def start_spider(self, project_name, spider_name, arguments):
+        post_data = dict(project=project_name, spider=spider_name)
+        post_data.update(arguments)
+        data = await self._request("post", self._scrapyd_url() + "/schedule.json", data=post_data)
+        return data['jobid'] if data and data['status'] == 'ok' else None
+
+    async def cancel_spider(self, project_name, job_id):
+        post_data = dict(project=project_name, job=job_id)
+        data = await self._request("post", self._scrapyd_url() + "/cancel.json", data=post_data)
+        return data != None
+
+    async def deploy(self, project_name, file_path, version=None):
+        with open(file_path, 'rb') as f:
+            post_data = aiohttp.FormData()
+            post_data.add_field('project', project_name)
+            post_data.add_field('version', str(version or int(time.time())))
+            post_data.add_field('egg', f, filename=os.path.basename(file_path))
+            data = await self._request("post", self._scrapyd_url() + '/addversion.json', data=post_data,
+                                       retry_times=1)
+        return data if data and data['status'] == 'ok' else None
@@ -1,9 +1,12 @@
+import asyncio
 import datetime
 import random
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from functools import reduce
 
-from SpiderKeeper.app import db
+from SpiderKeeper.app import db, app
 from SpiderKeeper.app.spider.model import SpiderStatus, JobExecution, JobInstance, Project, JobPriority
 from SpiderKeeper.app.util.dates import dts2ts
 
@@ -27,6 +30,13 @@ class SpiderServiceProxy(object):
         '''
         pass
 
+    def get_project_versions(self, project_name):
+        '''
+
+        :return: [version], None if the daemon could not be reached
+        '''
+        return None
+
     def get_spider_list(self, *args, **kwargs):
         '''
 
@@ -37,6 +47,10 @@ class SpiderServiceProxy(object):
         return NotImplementedError
 
     def get_daemon_status(self):
+        '''
+
+        :return: {'running': 0, 'pending': 0, 'finished': 0, 'node_name': ''}
+        '''
         return NotImplementedError
 
     def get_job_list(self, project_name, spider_status):
@@ -48,6 +62,23 @@ class SpiderServiceProxy(object):
         '''
         return NotImplementedError
 
+    def get_job_changes(self, project_name):
+        '''
+        jobs whose status changed since the last acknowledged poll,
+        services without change tracking report the full job list
+        :param project_name:
+        :return: {SpiderStatus: [job info]}
+        '''
+        return self.get_job_list(project_name)
+
+    def ack_job_changes(self, project_name, job_ids):
+        '''
+        mark reported jobs as applied so they are left out of later changes
+        :param project_name:
+        :param job_ids: {SpiderStatus: [job id]}
+        '''
+        pass
+
     def start_spider(self, *args, **kwargs):
         '''
 
@@ -66,162 +97,357 @@ class SpiderServiceProxy(object):
     def log_url(self, *args, **kwargs):
         pass
 
+    def read_log(self, *args, **kwargs):
+        '''
+
+        :return: {'data': b'', 'offset': 0, 'next_offset': 0, 'size': 0}
+        '''
+        return None
+
     @property
     def server(self):
         return self._server
 
+    @property
+    def available(self):
+        '''
+        False while the service is known to be unhealthy
+        '''
+        return True
+
 
 class SpiderAgent():
     def __init__(self):
         self.spider_service_instances = []
+        # load of each daemon refreshed by refresh_daemon_status: {server: daemon status}
+        self.daemon_status = {}
+        # event loop running coroutine service calls, started on first use
+        self._loop = None
+        self._loop_lock = threading.Lock()
 
     def regist(self, spider_service_proxy):
         if isinstance(spider_service_proxy, SpiderServiceProxy):
             self.spider_service_instances.append(spider_service_proxy)
 
+    @property
+    def available_instances(self):
+        return [spider_service_instance for spider_service_instance in self.spider_service_instances
+                if spider_service_instance.available]
+
     def get_project_list(self):
-        project_list = self.spider_service_instances[0].get_project_list()
-        Project.load_project(project_list)
+        project_dict = {}
+        for project_list in self._fan_out([(spider_service_instance, spider_service_instance.get_project_list, ())
+                                           for spider_service_instance in self.available_instances]).values():
+            for project in project_list or []:
+                project_dict.setdefault(project.project_name, project)
+        Project.load_project(list(project_dict.values()))
         return [project.to_dict() for project in Project.query.all()]
 
     def delete_project(self, project):
         for spider_service_instance in self.spider_service_instances:
-            spider_service_instance.delete_project(project.project_name)
+            self._call(spider_service_instance.delete_project, project.project_name)
+
+    def get_project_versions(self, project):
+        '''
+        :param project:
+        :return: {server: [version]}, daemons that did not answer are left out
+        '''
+        versions = self._fan_out([(spider_service_instance.server, spider_service_instance.get_project_versions,
+                                   (project.project_name,))
+                                  for spider_service_instance in self.available_instances])
+        return dict((server, project_versions) for server, project_versions in versions.items()
+                    if project_versions is not None)
 
     def get_spider_list(self, project):
-        spider_instance_list = self.spider_service_instances[0].get_spider_list(project.project_name)
-        for spider_instance in spider_instance_list:
-            spider_instance.project_id = project.id
-        return spider_instance_list
+        '''
+        spiders deployed on any daemon
+        a daemon without the project reports no spiders, the list is only complete when every daemon answered
+        :param project:
+        :return: ([SpiderInstance], True if every registered daemon answered),
+                 None if no daemon reported a spider and some did not answer
+        '''
+        spider_instance_lists = self._fan_out([(spider_service_instance, spider_service_instance.get_spider_list,
+                                                (project.project_name,))
+                                               for spider_service_instance in self.available_instances])
+        answered = [spider_instance_list for spider_instance_list in spider_instance_lists.values()
+                    if spider_instance_list is not None]
+        complete = len(answered) == len(self.spider_service_instances)
+        if not complete and not any(answered):
+            return None
+        spider_instance_dict = {}
+        for spider_service_instance in self.spider_service_instances:
+            for spider_instance in spider_instance_lists.get(spider_service_instance) or []:
+                spider_instance.project_id = project.id
+                spider_instance_dict.setdefault(spider_instance.spider_name, spider_instance)
+        return list(spider_instance_dict.values()), complete
 
     def get_daemon_status(self):
-        pass
+        return self.daemon_status
 
-    def sync_job_status(self, project):
-        for spider_service_instance in self.spider_service_instances:
-            job_status = spider_service_instance.get_job_list(project.project_name)
-            job_execution_list = JobExecution.list_uncomplete_job()
-            job_execution_dict = dict(
-                [(job_execution.service_job_execution_id, job_execution) for job_execution in job_execution_list])
-            # running
-            for job_execution_info in job_status[SpiderStatus.RUNNING]:
-                job_execution = job_execution_dict.get(job_execution_info['id'])
-                if job_execution and job_execution.running_status == SpiderStatus.PENDING:
-                    job_execution.start_time = job_execution_info['start_time']
-                    job_execution.running_status = SpiderStatus.RUNNING
+    def refresh_daemon_status(self, max_workers=None):
+        daemon_status = self._fan_out([(spider_service_instance, spider_service_instance.get_daemon_status, ())
+                                       for spider_service_instance in self.available_instances], max_workers)
+        self.daemon_status = dict((spider_service_instance.server, status)
+                                  for spider_service_instance, status in daemon_status.items()
+                                  if isinstance(status, dict))
+        return self.daemon_status
+
+    def _select_leaders(self, candidates, threshold):
+        '''
+        the least loaded daemons by running and pending jobs, each daemon is chosen at most once
+        :param candidates:
+        :param threshold: number of daemons wanted
+        :return: [spider_service_instance]
+        '''
+        def load(candidate):
+            status = self.daemon_status.get(candidate.server)
+            # daemons without a known load go last, ties are broken randomly
+            if not status:
+                return float('inf'), float('inf'), random.random()
+            return status['running'] + status['pending'], status['pending'], random.random()
+
+        leaders = sorted(candidates, key=load)[:threshold]
+        for leader in leaders:
+            status = self.daemon_status.get(leader.server)
+            if status:
+                # count the new job until the next refresh
+                status['pending'] += 1
+        return leaders
+
+    def _get_loop(self):
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=self._loop.run_forever, name='spider-agent-loop')
+                thread.daemon = True
+                thread.start()
+        return self._loop
+
+    def _call(self, func, *args):
+        '''
+        call a service method, coroutines are run on the agent event loop
+        '''
+        result = func(*args)
+        if asyncio.iscoroutine(result):
+            return asyncio.run_coroutine_threadsafe(result, self._get_loop()).result()
+        return result
 
+    async def _gather(self, calls, max_workers):
+        semaphore = asyncio.Semaphore(max_workers)
+
+        async def run(key, func, args):
+            async with semaphore:
+                try:
+                    return key, await func(*args)
+                except Exception as e:
+                    app.logger.warning('[fan_out] %s failed: %s' % (str(key), str(e)))
+                    return key, None
+
+        return dict(await asyncio.gather(*[run(key, func, args) for key, func, args in calls]))
+
+    def _fan_out(self, calls, max_workers=None):
+        '''
+        run service calls concurrently, coroutine calls on the agent event loop
+        and blocking calls on a bounded thread pool
+        :param calls: [(key, func, args)]
+        :param max_workers: concurrency limit, default one worker per call
+        :return: {key: result}, result is None if the call raised
+        '''
+        result = {}
+        if not calls:
+            return result
+        max_workers = max(1, min(max_workers or len(calls), len(calls)))
+        async_calls = [call for call in calls if asyncio.iscoroutinefunction(call[1])]
+        sync_calls = [call for call in calls if not asyncio.iscoroutinefunction(call[1])]
+        async_result = None
+        if async_calls:
+            async_result = asyncio.run_coroutine_threadsafe(self._gather(async_calls, max_workers),
+                                                            self._get_loop())
+        if sync_calls:
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(sync_calls))) as executor:
+                futures = [(key, executor.submit(func, *args)) for key, func, args in sync_calls]
+                for key, future in futures:
+                    try:
+                        result[key] = future.result()
+                    except Exception as e:
+                        app.logger.warning('[fan_out] %s failed: %s' % (str(key), str(e)))
+                        result[key] = None
+        if async_result:
+            result.update(async_result.result())
+        return result
+
+    def collect_job_status(self, projects, max_workers=None):
+        '''
+        fetch listjobs of every (daemon, project) at once
+        :param projects:
+        :param max_workers:
+        :return: {(spider_service_instance, project_name): job status}
+        '''
+        spider_service_instances = self.available_instances
+        calls = [((spider_service_instance, project.project_name),
+                  spider_service_instance.get_job_changes, (project.project_name,))
+                 for project in projects
+                 for spider_service_instance in spider_service_instances]
+        return self._fan_out(calls, max_workers)
+
+    def sync_job_status(self, projects, max_workers=None):
+        job_status_map = self.collect_job_status(projects, max_workers)
+        job_execution_index = JobExecution.index_uncomplete_job()
+        running_list, finished_list = [], []
+        acknowledged = {}
+        # finished jobs whose execution is not in the index: already complete, or not committed yet
+        unmatched = []
+        for (spider_service_instance, project_name), job_status in job_status_map.items():
+            if not job_status:
+                continue
+            server = spider_service_instance.server
+            ack = acknowledged[(spider_service_instance, project_name)] = {SpiderStatus.RUNNING: [],
+                                                                             SpiderStatus.FINISHED: []}
             # finished
             for job_execution_info in job_status[SpiderStatus.FINISHED]:
-                job_execution = job_execution_dict.get(job_execution_info['id'])
-                if job_execution and job_execution.running_status != SpiderStatus.FINISHED:
-                    job_execution.start_time = job_execution_info['start_time']
-                    job_execution.end_time = job_execution_info['end_time']
-                    job_execution.running_status = SpiderStatus.FINISHED
-            # commit
-            db.session.commit()
+                job_execution = job_execution_index.pop((server, job_execution_info['id']), None)
+                if not job_execution:
+                    unmatched.append((ack, server, job_execution_info['id'], job_execution_info['end_time']))
+                    continue
+                ack[SpiderStatus.FINISHED].append(job_execution_info['id'])
+                finished_list.append(dict(id=job_execution[0],
+                                          start_time=job_execution_info['start_time'],
+                                          end_time=job_execution_info['end_time'],
+                                          running_status=SpiderStatus.FINISHED))
+            # running, jobs without an execution yet are reported again on the next poll
+            for job_execution_info in job_status[SpiderStatus.RUNNING]:
+                job_execution = job_execution_index.get((server, job_execution_info['id']))
+                if not job_execution:
+                    continue
+                ack[SpiderStatus.RUNNING].append(job_execution_info['id'])
+                if job_execution[1] == SpiderStatus.PENDING:
+                    del job_execution_index[(server, job_execution_info['id'])]
+                    running_list.append(dict(id=job_execution[0],
+                                             start_time=job_execution_info['start_time'],
+                                             running_status=SpiderStatus.RUNNING))
+        # a job that finished before start_spider committed its execution is reported again on the next poll,
+        # jobs started outside SpiderKeeper or never recorded are acknowledged once they ended long enough ago
+        complete = JobExecution.index_complete_job(list(set(job_id for _, _, job_id, _ in unmatched)))
+        ended_before = datetime.datetime.now() - datetime.timedelta(
+            seconds=app.config.get('UNMATCHED_JOB_ACK_AGE', 300))
+        for ack, server, job_id, end_time in unmatched:
+            if (server, job_id) in complete or not end_time or end_time < ended_before:
+                ack[SpiderStatus.FINISHED].append(job_id)
+        JobExecution.update_job_status(running_list)
+        JobExecution.update_job_status(finished_list)
+        # commit
+        db.session.commit()
+        for (spider_service_instance, project_name), job_ids in acknowledged.items():
+            spider_service_instance.ack_job_changes(project_name, job_ids)
+
+    def _choose_leaders(self, arguments, threshold):
+        candidates = self.available_instances
+        if 'daemon' in arguments:
+            for candidate in candidates:
+                if candidate.server == arguments['daemon']:
+                    return [candidate]
+            app.logger.warning('[start_spider] daemon %s unavailable, choosing another one' % arguments['daemon'])
+        return self._select_leaders(candidates, threshold)
 
     def start_spider(self, job_instance):
+        '''
+        dispatch a job instance, keyword jobs run one spider per keyword
+        :param job_instance:
+        :return: {'dispatched': [service job id], 'failed': [keywords, spider_name for jobs without keywords]}
+        '''
         project = Project.find_project_by_id(job_instance.project_id)
         spider_name = job_instance.spider_name
         task_id = job_instance.id
-        if job_instance.keywords is not None:
-            keywords_list = job_instance.keywords.strip(',').split(',')
-            for keywords in keywords_list:
-                arguments = {}
-                if job_instance.spider_arguments:
-                    arguments = dict(map(lambda x: x.split("="), job_instance.spider_arguments.split(",")))
-                threshold = 0       # 阈值
-                leaders = []
-                arguments['keywords'] = keywords
-                arguments['video_time_short'] = job_instance.video_time_short
-                arguments['video_time_long'] = job_instance.video_time_long
-                if job_instance.upload_time_type == '设定区间':                 # 任务运行周期内自动设定最优时间参数
-                    arguments['startDate'] = dts2ts(job_instance.upload_time_start_date)
-                    arguments['endDate'] = dts2ts(job_instance.upload_time_end_date)
-                else:
-                    arguments['startDate'] = int(time.time()) - 3600*24*job_instance.spider_freq - 3600*24
-                    arguments['endDate'] = int(time.time())
-                arguments['task_id'] = task_id   # 将任务id加入到爬虫
-                daemon_size = len(self.spider_service_instances)
-                if job_instance.priority == JobPriority.HIGH:
-                    threshold = int(daemon_size / 2)
-                if job_instance.priority == JobPriority.HIGHEST:
-                    threshold = int(daemon_size)
-                threshold = 1 if threshold == 0 else threshold
-                candidates = self.spider_service_instances
-                if 'daemon' in arguments:
-                    for candidate in candidates:
-                        if candidate.server == arguments['daemon']:
-                            leaders = [candidate]
-                else:
-                    # TODO optimize some better func to vote the leader
-                    for i in range(threshold):
-                        leaders.append(random.choice(candidates))
-                for leader in leaders:
-                    print(project.project_name, spider_name, arguments)
-                    serviec_job_id = leader.start_spider(project.project_name, spider_name, arguments)
-                    job_execution = JobExecution()
-                    job_execution.project_id = job_instance.project_id
-                    job_execution.service_job_execution_id = serviec_job_id
-                    job_execution.job_instance_id = job_instance.id
-                    job_execution.create_time = datetime.datetime.now()
-                    job_execution.running_on = leader.server
-                    db.session.add(job_execution)
-                    db.session.commit()
+        result = {'dispatched': [], 'failed': []}
+        if not self.available_instances:
+            app.logger.error('[start_spider] no available daemon for job_instance_id:%s' % task_id)
+            result['failed'] = job_instance.keywords.strip(',').split(',') if job_instance.keywords is not None \
+                else [spider_name]
+            return result
+        base_arguments = {}
+        if job_instance.spider_arguments:
+            base_arguments = dict(map(lambda x: x.split("="), job_instance.spider_arguments.split(",")))
+        base_arguments['video_time_short'] = job_instance.video_time_short
+        base_arguments['video_time_long'] = job_instance.video_time_long
+        if job_instance.keywords is None or job_instance.upload_time_type == '设定区间':  # 任务运行周期内自动设定最优时间参数
+            base_arguments['startDate'] = dts2ts(job_instance.upload_time_start_date)
+            base_arguments['endDate'] = dts2ts(job_instance.upload_time_end_date)
         else:
-            arguments = {}
-            if job_instance.spider_arguments:
-                arguments = dict(map(lambda x: x.split("="), job_instance.spider_arguments.split(",")))
-            threshold = 0  # 阈值
-            leaders = []
-            arguments['video_time_short'] = job_instance.video_time_short
-            arguments['video_time_long'] = job_instance.video_time_long
-            arguments['startDate'] = dts2ts(job_instance.upload_time_start_date)
-            arguments['endDate'] = dts2ts(job_instance.upload_time_end_date)
-            arguments['task_id'] = task_id  # 将任务id加入到爬虫
-            daemon_size = len(self.spider_service_instances)
-            if job_instance.priority == JobPriority.HIGH:
-                threshold = int(daemon_size / 2)
-            if job_instance.priority == JobPriority.HIGHEST:
-                threshold = int(daemon_size)
-            threshold = 1 if threshold == 0 else threshold
-            candidates = self.spider_service_instances
-            if 'daemon' in arguments:
-                for candidate in candidates:
-                    if candidate.server == arguments['daemon']:
-                        leaders = [candidate]
-            else:
-                # TODO optimize some better func to vote the leader
-                for i in range(threshold):
-                    leaders.append(random.choice(candidates))
-            for leader in leaders:
-                print(project.project_name, spider_name, arguments)
-                serviec_job_id = leader.start_spider(project.project_name, spider_name, arguments)
-                job_execution = JobExecution()
-                job_execution.project_id = job_instance.project_id
-                job_execution.service_job_execution_id = serviec_job_id
-                job_execution.job_instance_id = job_instance.id
-                job_execution.create_time = datetime.datetime.now()
-                job_execution.running_on = leader.server
-                db.session.add(job_execution)
-                db.session.commit()
+            base_arguments['startDate'] = int(time.time()) - 3600*24*job_instance.spider_freq - 3600*24
+            base_arguments['endDate'] = int(time.time())
+        base_arguments['task_id'] = task_id   # 将任务id加入到爬虫
+        threshold = 0       # 阈值
+        daemon_size = len(self.spider_service_instances)
+        if job_instance.priority == JobPriority.HIGH:
+            threshold = int(daemon_size / 2)
+        if job_instance.priority == JobPriority.HIGHEST:
+            threshold = int(daemon_size)
+        threshold = 1 if threshold == 0 else threshold
+
+        keywords_list = job_instance.keywords.strip(',').split(',') if job_instance.keywords is not None else [None]
+        calls = []
+        for index, keywords in enumerate(keywords_list):
+            arguments = dict(base_arguments)
+            if keywords is not None:
+                arguments['keywords'] = keywords
+            for leader in self._choose_leaders(arguments, threshold):
+                calls.append(((index, leader), leader.start_spider, (project.project_name, spider_name, arguments)))
+        service_job_ids = self._fan_out(calls, app.config.get('DISPATCH_CONCURRENCY'))
+
+        job_executions = []
+        for (index, leader), serviec_job_id in sorted(service_job_ids.items(), key=lambda item: item[0][0]):
+            keywords = keywords_list[index]
+            if not serviec_job_id:
+                failed = keywords if keywords is not None else spider_name
+                if failed not in result['failed']:
+                    result['failed'].append(failed)
+                continue
+            job_execution = JobExecution()
+            job_execution.project_id = job_instance.project_id
+            job_execution.service_job_execution_id = serviec_job_id
+            job_execution.job_instance_id = job_instance.id
+            job_execution.create_time = datetime.datetime.now()
+            job_execution.running_on = leader.server
+            job_executions.append(job_execution)
+            result['dispatched'].append(serviec_job_id)
+        db.session.bulk_save_objects(job_executions)
+        db.session.commit()
+        if result['failed']:
+            app.logger.warning('[start_spider][job_instance_id:%s] failed to dispatch: %s' % (
+                task_id, ','.join(result['failed'])))
+        return result
 
     def cancel_spider(self, job_execution):
         job_instance = JobInstance.find_job_instance_by_id(job_execution.job_instance_id)
         project = Project.find_project_by_id(job_instance.project_id)
         for spider_service_instance in self.spider_service_instances:
             if spider_service_instance.server == job_execution.running_on:
-                if spider_service_instance.cancel_spider(project.project_name, job_execution.service_job_execution_id):
+                if self._call(spider_service_instance.cancel_spider, project.project_name,
+                              job_execution.service_job_execution_id):
                     job_execution.end_time = datetime.datetime.now()
                     job_execution.running_status = SpiderStatus.CANCELED
                     db.session.commit()
                 break
 
-    def deploy(self, project, file_path):
-        for spider_service_instance in self.spider_service_instances:
-            if not spider_service_instance.deploy(project.project_name, file_path):
-                return False
-        return True
+    def deploy(self, project, file_path, servers=None, version=None):
+        '''
+        upload an egg to the daemons concurrently, every daemon gets the same version
+        :param project:
+        :param file_path: egg on disk, each upload streams its own handle of it
+        :param servers: only deploy to these daemons, e.g. to retry the failed ones
+        :param version: egg version, default now
+        :return: {server: True/False}
+        '''
+        version = version or int(time.time())
+        calls = [(spider_service_instance.server, spider_service_instance.deploy,
+                  (project.project_name, file_path, version))
+                 for spider_service_instance in self.spider_service_instances
+                 if servers is None or spider_service_instance.server in servers]
+        results = self._fan_out(calls)
+        for server, result in results.items():
+            if not result:
+                app.logger.warning('[deploy] %s to %s failed' % (project.project_name, server))
+        return dict((server, bool(result)) for server, result in results.items())
 
     def log_url(self, job_execution):
         job_instance = JobInstance.find_job_instance_by_id(job_execution.job_instance_id)
@@ -231,6 +457,22 @@ class SpiderAgent():
                 return spider_service_instance.log_url(project.project_name, job_instance.spider_name,
                                                        job_execution.service_job_execution_id)
 
+    def read_log(self, job_execution, offset, length=None):
+        '''
+        :param job_execution:
+        :param offset: first byte, negative to read the last -offset bytes
+        :param length: max bytes from offset
+        :return: dict(data, offset, next_offset, size), None if the daemon has no such log
+        :raise IOError: the daemon is not registered, could not be reached or failed
+        '''
+        job_instance = JobInstance.find_job_instance_by_id(job_execution.job_instance_id)
+        project = Project.find_project_by_id(job_instance.project_id)
+        for spider_service_instance in self.spider_service_instances:
+            if spider_service_instance.server == job_execution.running_on:
+                return self._call(spider_service_instance.read_log, project.project_name, job_instance.spider_name,
+                                  job_execution.service_job_execution_id, offset, length)
+        raise IOError('daemon %s of job execution %s not registered' % (job_execution.running_on, job_execution.id))
+
     @property
     def servers(self):
         return [self.spider_service_instance.server for self.spider_service_instance in
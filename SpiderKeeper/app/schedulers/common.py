@@ -1,11 +1,16 @@
 import datetime
+import os
 import threading
 import time
 
+from SpiderKeeper.app.util.eggstore import egg_path
 from SpiderKeeper.app.util.http import request_get
+from SpiderKeeper.app.util.logstore import write_log, LogMirror
+from SpiderKeeper.app.util.scrapystats import parse_stats, elapsed_seconds
 
 from SpiderKeeper.app import scheduler, app, agent, db
-from SpiderKeeper.app.spider.model import Project, JobInstance, SpiderInstance, WebMonitor, WebMonitorLog
+from SpiderKeeper.app.spider.model import Project, JobInstance, SpiderInstance, WebMonitor, WebMonitorLog, \
+    ProjectEgg, EggDeployment, JobLogMirror, JobExecutionStats, VideoDailyCount
 
 
 def sync_job_execution_status_job():
@@ -13,9 +18,23 @@ def sync_job_execution_status_job():
     sync job execution running status
     :return:
     """
-    for project in Project.query.all():
-        agent.sync_job_status(project)
-    app.logger.debug('[sync_job_execution_status]')
+    start = time.time()
+    projects = Project.query.all()
+    agent.sync_job_status(projects, max_workers=app.config.get('SYNC_JOB_STATUS_CONCURRENCY'))
+    elapsed = time.time() - start
+    app.logger.debug('[sync_job_execution_status][projects:%s][daemons:%s][elapsed:%.3fs]' % (
+        len(projects), len(agent.spider_service_instances), elapsed))
+    if elapsed > app.config.get('SYNC_JOB_STATUS_INTERVAL', 5):
+        app.logger.warning('[sync_job_execution_status] cycle took %.3fs, longer than the sync interval' % elapsed)
+
+
+def sync_daemon_status():
+    """
+    refresh daemon load used to choose where spiders run
+    :return:
+    """
+    agent.refresh_daemon_status()
+    app.logger.debug('[sync_daemon_status]')
 
 
 def sync_job_instance_status():
@@ -36,11 +55,103 @@ def sync_spiders():
     :return:
     """
     for project in Project.query.all():
-        spider_instance_list = agent.get_spider_list(project)
-        SpiderInstance.update_spider_instances(project.id, spider_instance_list)
+        spider_list = agent.get_spider_list(project)
+        if spider_list is None:
+            continue
+        spider_instance_list, complete = spider_list
+        # a daemon that did not answer may hold spiders the others lack, they are only removed once all answered
+        SpiderInstance.update_spider_instances(project.id, spider_instance_list, remove_missing=complete)
     app.logger.debug('[sync_spiders]')
 
 
+def sync_eggs():
+    """
+    deploy the current egg of each project from the egg store to daemons that lost or never got it
+    :return:
+    """
+    for project_egg in ProjectEgg.list_current():
+        project = Project.find_project_by_id(project_egg.project_id)
+        file_path = egg_path(app.config.get('EGG_STORE_DIR'), project_egg.egg_hash)
+        if not project or not os.path.exists(file_path):
+            continue
+        project_versions = agent.get_project_versions(project)
+        servers = [server for server, versions in project_versions.items() if project_egg.version not in versions]
+        EggDeployment.record(project_egg, [server for server in project_versions if server not in servers])
+        if not servers:
+            continue
+        deploy_result = agent.deploy(project, file_path, servers=servers, version=project_egg.version)
+        EggDeployment.record(project_egg, [server for server, ok in deploy_result.items() if ok])
+        app.logger.info('[sync_eggs][project:%s][version:%s][deployed:%s]' % (
+            project.project_name, project_egg.version, ','.join(server for server, ok in deploy_result.items() if ok)))
+    app.logger.debug('[sync_eggs]')
+
+
+def _read_log_chunks(job_execution, chunk_size=1024 * 1024):
+    offset = 0
+    while True:
+        # a daemon gone away or failing raises IOError, the log is tried again later
+        chunk = agent.read_log(job_execution, offset, chunk_size)
+        if chunk is None:
+            # a log scrapyd no longer keeps is mirrored empty
+            if offset == 0:
+                return
+            raise IOError('log of job execution %s removed while read' % job_execution.id)
+        if not chunk['data']:
+            return
+        yield chunk['data']
+        offset = chunk['next_offset']
+        if offset >= chunk['size']:
+            return
+
+
+def mirror_job_logs():
+    """
+    copy logs of finished jobs into the local log mirror
+    :return:
+    """
+    servers = [spider_service_instance.server for spider_service_instance in agent.available_instances]
+    for job_execution in JobLogMirror.list_unmirrored(servers, app.config.get('LOG_MIRROR_BATCH', 20)):
+        try:
+            size, line_count = write_log(app.config.get('LOG_MIRROR_DIR'), str(job_execution.id),
+                                         _read_log_chunks(job_execution))
+        except IOError as e:
+            app.logger.warning('[mirror_job_logs] %s' % str(e))
+            continue
+        if not JobLogMirror.add(job_execution.id, size, line_count):
+            app.logger.debug('[mirror_job_logs] %s mirrored by another process' % job_execution.id)
+    app.logger.debug('[mirror_job_logs]')
+
+
+def ingest_job_stats():
+    """
+    parse the scrapy stats at the end of mirrored logs into per execution metrics
+    :return:
+    """
+    tail_lines = app.config.get('STATS_TAIL_LINES', 300)
+    for job_execution in JobExecutionStats.list_unparsed(app.config.get('LOG_MIRROR_BATCH', 20)):
+        try:
+            with LogMirror(app.config.get('LOG_MIRROR_DIR'), str(job_execution.id)) as log_mirror:
+                stats = parse_stats(log_mirror.read_lines(max(log_mirror.line_count - tail_lines, 0), tail_lines))
+        except (IOError, ValueError) as e:
+            app.logger.warning('[ingest_job_stats] %s' % str(e))
+            continue
+        elapsed = elapsed_seconds(stats) if stats else None
+        if elapsed is None and job_execution.start_time and job_execution.end_time:
+            elapsed = (job_execution.end_time - job_execution.start_time).total_seconds()
+        if not JobExecutionStats.add(job_execution, stats, elapsed):
+            app.logger.debug('[ingest_job_stats] %s parsed by another process' % job_execution.id)
+    app.logger.debug('[ingest_job_stats]')
+
+
+def roll_up_video_counts():
+    """
+    add new videoitems to the daily counts read by the collection statistics
+    :return:
+    """
+    added = VideoDailyCount.roll_up(app.config.get('VIDEO_ROLLUP_BATCH', 50000), app.config.get('VIDEO_ROLLUP_LAG', 30))
+    app.logger.debug('[roll_up_video_counts] %s videos' % added)
+
+
 def run_spider_job(job_instance_id):
     """
     run spider by scheduler
@@ -3,12 +3,14 @@ import datetime
 import json
 import os
 import random
+import re
 import tempfile
+import time
+from collections import defaultdict
 from functools import wraps
 
 import flask_restful
 import math
-import requests
 from flask import Blueprint, request, jsonify, g, make_response
 from flask import abort
 from flask import flash
@@ -21,8 +23,15 @@ from flask.ext.httpauth import HTTPBasicAuth
 
 from SpiderKeeper.app import db, api, agent, app
 from SpiderKeeper.app.spider.model import JobInstance, Project, JobExecution, SpiderInstance, JobRunType, Videoitems, \
-    WebMonitor, WebMonitorLog, User
-from SpiderKeeper.app.util.dates import dts2ts
+    WebMonitor, WebMonitorLog, User, ProjectEgg, EggDeployment, SpiderStatus, JobLogMirror, \
+    JobExecutionStats, VideoDailyCount
+from SpiderKeeper.app.util.cache import TTLCache
+from SpiderKeeper.app.util.dates import dts2ts, parse_date, format_date, format_datetime
+from SpiderKeeper.app.util.eggstore import store_egg, egg_path
+from SpiderKeeper.app.util.http import get_client
+from SpiderKeeper.app.util.logstore import LogMirror
+from SpiderKeeper.app.util.pagination import paginate, total_pages
+from SpiderKeeper.app.util.windows import DailySums
 from SpiderKeeper.config import SERVERS
 
 api_spider_bp = Blueprint('spider', __name__)
@@ -131,6 +140,39 @@ def get_resource():
     return jsonify({'data': 'Hello, %s!' % g.user.user_name})
 
 
+# 列表总数缓存, 同样的筛选条件在有效期内不再重复count
+total_cache = TTLCache(app.config.get('PAGE_TOTAL_CACHE_TTL', 60), app.config.get('PAGE_TOTAL_CACHE_SIZE', 1000))
+
+# 游标分页的swagger参数
+CURSOR_PARAMETERS = [{
+    "name": "cursor",
+    "description": "上一页返回的next_cursor, 有cursor时忽略page",
+    "required": False,
+    "paramType": "query",
+    "dataType": 'string'
+}, {
+    "name": "with_total",
+    "description": "为0时不返回总数和总页数",
+    "required": False,
+    "paramType": "query",
+    "dataType": 'int'
+}]
+
+
+def page_total(name, query):
+    '''
+    row count of a list api, cached per filter for PAGE_TOTAL_CACHE_TTL seconds
+    :param name: list api and its path arguments
+    :param query: filtered query
+    :return: count, None when the client passes with_total=0
+    '''
+    if request.args.get('with_total', 1, type=int) != 1:
+        return None
+    key = (name,) + tuple(sorted((key, value) for key, value in request.args.items()
+                                 if key not in ('cursor', 'with_total')))
+    return total_cache.get(key, lambda: query.order_by(None).count())
+
+
 class ProjectCtrl(flask_restful.Resource):
     @swagger.operation(
         summary='list projects',
@@ -302,56 +344,54 @@ class VideosCtrl(flask_restful.Resource):
                 "required": False,
                 "paramType": "query",
                 "dataType": 'int'
-            }]
+            }] + CURSOR_PARAMETERS
     )
     def get(self, page):
-        start_date = request.args.get('start_date')  # 开始时间
-        end_date = request.args.get('end_date')  # 结束时间
+        start_date = parse_date(request.args.get('start_date'))  # 开始时间
+        end_date = parse_date(request.args.get('end_date'))  # 结束时间
         title = request.args.get('title')  # 视频名称
         site_name = request.args.get('site_name')  # 视频来源
-        job_id = request.args.get('job_id')  # 任务名称
+        job_id = request.args.get('job_id', type=int)  # 任务名称
 
-        videos = Videoitems.query.order_by(db.desc(Videoitems.id))
+        filters = []
         if start_date:
-            videos = videos.filter(Videoitems.spider_time >= start_date)
+            filters.append(Videoitems.spider_time >= start_date)
         if end_date:
-            videos = videos.filter(Videoitems.spider_time <= end_date)
+            filters.append(Videoitems.spider_time <= end_date)
         if title:
-            videos = videos.filter(Videoitems.title_cn.contains(title))  # 视频名称
+            filters.append(Videoitems.title_filter(title))  # 视频名称
         if site_name:
-            videos = videos.filter_by(site_name=site_name)
-        if job_id:
-            videos = videos.filter_by(task_id=job_id)
-
-        web_list = []
-        job_name_list = []
-        for job_instance in JobInstance.query.all():
-            job = {'job_name': job_instance.job_name, 'job_id': job_instance.id}
-            job_name_list.append(job)
-        for target_web in WebMonitor.query.all():
-            web_list.append(target_web.web_name)
-        page = int(page)
-        pagination = videos.paginate(page, per_page=10, error_out=False)
-        videos = pagination.items
-        video_num = pagination.total
-        total_page = pagination.pages
+            filters.append(Videoitems.site_name == site_name)
+        if job_id is not None:
+            filters.append(Videoitems.task_id == job_id)
+        # job names come from the same query, videos of removed jobs keep an empty job name
+        videos = db.session.query(Videoitems.id, Videoitems.task_id, Videoitems.title, Videoitems.spider_time,
+                                  Videoitems.site_name, JobInstance.id, JobInstance.job_name).outerjoin(
+            JobInstance, JobInstance.id == Videoitems.task_id).filter(*filters)
+
+        web_list = WebMonitor.list_web_names()
+        job_name_list = JobInstance.list_job_names()
+        videos, next_cursor = paginate(videos, [(Videoitems.id, True)], lambda video: [video[0]],
+                                       request.args.get('cursor'), int(page))
+        video_num = page_total('videos', Videoitems.query.filter(*filters))
+        total_page = total_pages(video_num)
         response = {}
         rsts = []
-        for video in videos:
-            job_instance = JobInstance.query.filter_by(id=video.task_id).first()
+        for video_id, task_id, title, spider_time, site_name, job_instance_id, job_name in videos:
             rst = {
-                'video_id': video.id,
-                'task_id': video.task_id,
-                'job_id': job_instance.id,
-                'title': video.title,
-                'spider_time': video.spider_time,
-                'site_name': video.site_name,
-                'job_name': job_instance.job_name,
+                'video_id': video_id,
+                'task_id': task_id,
+                'job_id': job_instance_id,
+                'title': title,
+                'spider_time': format_date(spider_time),
+                'site_name': site_name,
+                'job_name': job_name,
 
             }
             rsts.append(rst)
         response['video_num'] = video_num
         response['total_page'] = total_page
+        response['next_cursor'] = next_cursor
         response['rsts'] = rsts
         response['web_list'] = web_list
         response['job_name_list'] = job_name_list
@@ -359,6 +399,49 @@ class VideosCtrl(flask_restful.Resource):
         return jsonify({'rst': response, 'code': 200, })
 
 
+class VideoSearchCtrl(flask_restful.Resource):
+    @auth.login_required
+    @swagger.operation(
+        summary='视频标题全文搜索，按相关度排序',
+        parameters=[{
+            "name": "username_or_token",
+            "description": "token",
+            "required": True,
+            "paramType": "header",
+            "dataType": 'string'
+        }, {
+            "name": "q",
+            "description": "关键字，匹配视频名称和中文名称",
+            "required": True,
+            "paramType": "query",
+            "dataType": 'string'
+        }, {
+            "name": "limit",
+            "description": "最多返回条数，默认20",
+            "required": False,
+            "paramType": "query",
+            "dataType": 'int'
+        }]
+    )
+    def get(self):
+        q = (request.args.get('q') or '').strip()
+        if not q:
+            return jsonify({'rst': '缺少关键字', 'code': 400, 'user_name': g.user.user_name})
+        limit = min(request.args.get('limit', 20, type=int), 200)
+        rsts = []
+        for video, score in Videoitems.search_titles(q, limit):
+            rsts.append({
+                'video_id': video.id,
+                'task_id': video.task_id,
+                'title': video.title,
+                'title_cn': video.title_cn,
+                'spider_time': format_date(video.spider_time),
+                'site_name': video.site_name,
+                'score': score,
+            })
+        return jsonify({'rst': rsts, 'code': 200, 'user_name': g.user.user_name})
+
+
 def num2time(num):
     m = num % 60
     s = num // 60 % 60
@@ -396,11 +479,11 @@ class VideoDetail(flask_restful.Resource):
 
         rst = {
             'title': video.title,
-            'spider_time': video.spider_time,
+            'spider_time': format_date(video.spider_time),
             'site_name': video.site_name,
             'job_name': JobInstance.query.filter_by(id=video.task_id).first().job_name,
             'url': video.url,
-            'upload_time': video.upload_time,
+            'upload_time': format_datetime(video.upload_time),
             'info': video.info,
             'video_time': num2time(video.video_time),
         }
@@ -1044,7 +1127,7 @@ class JobExecutionCtrl(flask_restful.Resource):
             "required": False,
             "paramType": "query",
             "dataType": 'int'
-        }]
+        }] + CURSOR_PARAMETERS
     )
     def get(self, page):
         start_date = request.args.get('start_date')  # 开始时间
@@ -1052,7 +1135,7 @@ class JobExecutionCtrl(flask_restful.Resource):
         job_id = request.args.get('job_id')  # 任务id
         # job_status = request.args.get('job_status')      # 任务状态
         running_status = request.args.get('running_status')  # 执行情况
-        job_excutions = JobExecution.query.order_by(db.desc(JobExecution.id))
+        job_excutions = JobExecution.query
         if start_date:
             job_excutions = job_excutions.filter(JobExecution.date_created >= start_date)
         if end_date:
@@ -1064,22 +1147,29 @@ class JobExecutionCtrl(flask_restful.Resource):
         if running_status:
             job_excutions = job_excutions.filter_by(running_status=running_status)
 
-        job_name_list = []
-        for job_excution1 in JobInstance.query.all():
-            job_id = job_excution1.id
-            if job_id not in job_name_list:
-                job_name_list.append({'job_id': job_id,
-                                  'job_name': JobInstance.query.filter_by(id=job_id).first().job_name})
-        page = int(page)
-        pagination = job_excutions.paginate(page, per_page=10, error_out=False)
-        job_excutions = pagination.items
-        job_excution_num = pagination.total
-        total_page = pagination.pages
+        job_name_list = JobInstance.list_job_names()
+        job_excution_num = page_total('job_executions', job_excutions)
+        total_page = total_pages(job_excution_num)
+        job_excutions, next_cursor = paginate(job_excutions, [(JobExecution.id, True)],
+                                              lambda job_excution: [job_excution.id],
+                                              request.args.get('cursor'), int(page))
+        # 本页的任务和每次执行当天的采集数量各用一次查询取出
+        task_ids = set(job_excution.job_instance_id for job_excution in job_excutions)
+        dates = set(job_excution.start_time.date() for job_excution in job_excutions if job_excution.start_time)
+        job_instances = dict((job_instance.id, job_instance) for job_instance in
+                             JobInstance.query.filter(JobInstance.id.in_(task_ids))) if task_ids else {}
+        video_nums = dict(((task_id, spider_time), count) for task_id, spider_time, count in db.session.query(
+            Videoitems.task_id, Videoitems.spider_time, db.func.count(Videoitems.id)).filter(
+            Videoitems.task_id.in_(task_ids), Videoitems.spider_time.in_(dates)).group_by(
+            Videoitems.task_id, Videoitems.spider_time)) if dates else {}
         response = {}
         rsts = []
         for job_excution in job_excutions:
-            job_instance = JobInstance.query.filter_by(id=job_excution.job_instance_id).first()
-            if job_instance.run_type == '持续运行' and job_instance.enabled == 0:
+            job_instance = job_instances.get(job_excution.job_instance_id)
+            date = job_excution.start_time.date() if job_excution.start_time else None
+            if not job_instance:
+                job_status = None
+            elif job_instance.run_type == '持续运行' and job_instance.enabled == 0:
                 job_status = '运行中'
             elif job_instance.enabled == -1:
                 job_status = '已暂停'
@@ -1087,17 +1177,17 @@ class JobExecutionCtrl(flask_restful.Resource):
                 job_status = '运行完成'
             rst = {
                 'job_id': job_excution.job_instance_id,
-                'job_name': job_instance.job_name,
-                'date': job_excution.start_time.strftime('%Y-%m-%d'),
+                'job_name': job_instance.job_name if job_instance else None,
+                'date': format_date(date),
                 'job_status': job_status,
-                'enabled': job_instance.enabled,
+                'enabled': job_instance.enabled if job_instance else None,
                 'running_status': job_excution.running_status,
-                'video_num': Videoitems.query.filter_by(spider_time=job_excution.start_time.strftime('%Y-%m-%d'),
-                                                        task_id=job_excution.job_instance_id).count()
+                'video_num': video_nums.get((job_excution.job_instance_id, date), 0)
             }
             rsts.append(rst)
         response['job_excution_num'] = job_excution_num
         response['total_page'] = total_page
+        response['next_cursor'] = next_cursor
         response['rsts'] = rsts
         response['job_name_list'] = job_name_list
         response['user_name'] = g.user.user_name
@@ -1131,6 +1221,193 @@ class JobExecutionDetailCtrl(flask_restful.Resource):
             return True
 
 
+class JobExecutionLogCtrl(flask_restful.Resource):
+    @auth.login_required
+    @swagger.operation(
+        summary='任务执行日志, 默认返回日志末尾',
+        parameters=[{
+            "name": "username_or_token",
+            "description": "token",
+            "required": True,
+            "paramType": "header",
+            "dataType": 'string'
+        }, {
+            "name": "job_exec_id",
+            "description": "job_execution_id",
+            "required": True,
+            "paramType": "path",
+            "dataType": 'int'
+        }, {
+            "name": "tail",
+            "description": "读取日志最后多少KB",
+            "required": False,
+            "paramType": "query",
+            "dataType": 'int'
+        }, {
+            "name": "offset",
+            "description": "从该字节开始读取, 传入上次返回的next_offset可持续获取新增日志",
+            "required": False,
+            "paramType": "query",
+            "dataType": 'int'
+        }, {
+            "name": "length",
+            "description": "从offset开始最多读取的字节数",
+            "required": False,
+            "paramType": "query",
+            "dataType": 'int'
+        }, {
+            "name": "start_line",
+            "description": "从本地日志镜像读取, 起始行号(从0开始)",
+            "required": False,
+            "paramType": "query",
+            "dataType": 'int'
+        }, {
+            "name": "line_count",
+            "description": "从本地日志镜像读取的行数, 默认100",
+            "required": False,
+            "paramType": "query",
+            "dataType": 'int'
+        }]
+    )
+    def get(self, job_exec_id):
+        job_execution = JobExecution.query.filter_by(id=job_exec_id).first()
+        if not job_execution:
+            return jsonify({'rst': '任务执行不存在', 'code': 404, 'user_name': g.user.user_name})
+        start_line = request.args.get('start_line', type=int)
+        if start_line is not None:
+            try:
+                with LogMirror(app.config.get('LOG_MIRROR_DIR'), str(job_execution.id)) as log_mirror:
+                    lines = log_mirror.read_lines(start_line, request.args.get('line_count', 100, type=int))
+                    total = log_mirror.line_count
+            except (IOError, ValueError):
+                return jsonify({'rst': '日志未镜像到本地', 'code': 404, 'user_name': g.user.user_name})
+            return jsonify({'rst': {'lines': lines, 'start_line': start_line, 'total': total}, 'code': 200,
+                            'user_name': g.user.user_name})
+        log = read_job_log(job_execution, request.args.get('tail', type=int), request.args.get('offset', type=int),
+                           request.args.get('length', type=int))
+        if log is None:
+            return jsonify({'rst': '日志读取失败', 'code': 404, 'user_name': g.user.user_name})
+        return jsonify({'rst': log, 'code': 200, 'user_name': g.user.user_name})
+
+
+class JobLogSearchCtrl(flask_restful.Resource):
+    @auth.login_required
+    @swagger.operation(
+        summary='搜索本地镜像的任务日志',
+        parameters=[{
+            "name": "username_or_token",
+            "description": "token",
+            "required": True,
+            "paramType": "header",
+            "dataType": 'string'
+        }, {
+            "name": "q",
+            "description": "搜索的字符串或正则表达式",
+            "required": True,
+            "paramType": "query",
+            "dataType": 'string'
+        }, {
+            "name": "regex",
+            "description": "q为正则表达式时为1",
+            "required": False,
+            "paramType": "query",
+            "dataType": 'int'
+        }, {
+            "name": "ignore_case",
+            "description": "忽略大小写时为1",
+            "required": False,
+            "paramType": "query",
+            "dataType": 'int'
+        }, {
+            "name": "job_exec_id",
+            "description": "只搜索该次执行的日志",
+            "required": False,
+            "paramType": "query",
+            "dataType": 'int'
+        }, {
+            "name": "job_id",
+            "description": "搜索该任务所有执行的日志",
+            "required": False,
+            "paramType": "query",
+            "dataType": 'int'
+        }, {
+            "name": "limit",
+            "description": "最多返回的行数, 默认100",
+            "required": False,
+            "paramType": "query",
+            "dataType": 'int'
+        }]
+    )
+    def get(self):
+        q = request.args.get('q')
+        job_exec_id = request.args.get('job_exec_id', type=int)
+        job_id = request.args.get('job_id', type=int)
+        limit = request.args.get('limit', 100, type=int)
+        if not q or (job_exec_id is None and job_id is None):
+            return jsonify({'rst': '缺少q及job_exec_id或job_id', 'code': 400, 'user_name': g.user.user_name})
+        job_execution_ids = [job_exec_id] if job_exec_id is not None else JobLogMirror.list_job_execution_ids(job_id)
+        rsts = []
+        for job_execution_id in job_execution_ids:
+            try:
+                with LogMirror(app.config.get('LOG_MIRROR_DIR'), str(job_execution_id)) as log_mirror:
+                    matches = log_mirror.search(q, regex=request.args.get('regex', 0, type=int) == 1,
+                                                ignore_case=request.args.get('ignore_case', 0, type=int) == 1,
+                                                limit=limit - len(rsts))
+            except (IOError, ValueError):
+                continue
+            except re.error as e:
+                return jsonify({'rst': '正则表达式错误: %s' % str(e), 'code': 400, 'user_name': g.user.user_name})
+            rsts.extend({'job_exec_id': job_execution_id, 'line': line_no, 'text': text} for line_no, text in matches)
+            if len(rsts) >= limit:
+                break
+        return jsonify({'rst': rsts, 'code': 200, 'user_name': g.user.user_name})
+
+
+class JobStatsCtrl(flask_restful.Resource):
+    @auth.login_required
+    @swagger.operation(
+        summary='爬取速率统计(items/sec, requests/sec)',
+        parameters=[{
+            "name": "username_or_token",
+            "description": "token",
+            "required": True,
+            "paramType": "header",
+            "dataType": 'string'
+        }, {
+            "name": "group_by",
+            "description": "统计维度: spider, daemon 或 job, 默认spider",
+            "required": False,
+            "paramType": "query",
+            "dataType": 'string'
+        }, {
+            "name": "start_date",
+            "description": "开始时间",
+            "required": False,
+            "paramType": "query",
+            "dataType": 'string'
+        }, {
+            "name": "end_date",
+            "description": "结束时间",
+            "required": False,
+            "paramType": "query",
+            "dataType": 'string'
+        }, {
+            "name": "by_day",
+            "description": "按天统计时为1",
+            "required": False,
+            "paramType": "query",
+            "dataType": 'int'
+        }]
+    )
+    def get(self):
+        group_by = request.args.get('group_by', 'spider')
+        if group_by not in ('spider', 'daemon', 'job'):
+            return jsonify({'rst': 'group_by只能为spider, daemon或job', 'code': 400, 'user_name': g.user.user_name})
+        rsts = JobExecutionStats.throughput(group_by, request.args.get('start_date'), request.args.get('end_date'),
+                                            request.args.get('by_day', 0, type=int) == 1)
+        return jsonify({'rst': rsts, 'code': 200, 'user_name': g.user.user_name})
+
+
 class WebMonitorCtrl(flask_restful.Resource):
     @auth.login_required
     @swagger.operation(
@@ -1165,7 +1442,7 @@ class WebMonitorCtrl(flask_restful.Resource):
             "required": False,
             "paramType": "query",
             "dataType": 'string'
-        }, ]
+        }, ] + CURSOR_PARAMETERS
     )
     def get(self, page):
         web_name = request.args.get('web_name')
@@ -1181,11 +1458,11 @@ class WebMonitorCtrl(flask_restful.Resource):
         target_web_list = []
         for target_web in WebMonitor.query.all():
             target_web_list.append({'web_id': target_web.id, 'web_name': target_web.web_name})
-        page = int(page)
-        pagination = target_web_monitors.paginate(page, per_page=10, error_out=False)
-        target_web_monitors = pagination.items
-        total_page = pagination.pages
-        target_web_num = pagination.total
+        target_web_num = page_total('web_monitors', target_web_monitors)
+        total_page = total_pages(target_web_num)
+        target_web_monitors, next_cursor = paginate(target_web_monitors, [(WebMonitor.id, False)],
+                                                    lambda target_web_monitor: [target_web_monitor.id],
+                                                    request.args.get('cursor'), int(page))
         response = {}
         rsts = []
         for target_web_monitor in target_web_monitors:
@@ -1203,6 +1480,7 @@ class WebMonitorCtrl(flask_restful.Resource):
             rsts.append(rst)
         response['target_web_num'] = target_web_num
         response['total_page'] = total_page
+        response['next_cursor'] = next_cursor
         response['rsts'] = rsts
         response['target_web_list'] = target_web_list
         response['user_name'] = g.user.user_name
@@ -1232,15 +1510,15 @@ class WebMonitorDetailCtrl(flask_restful.Resource):
                 "required": True,
                 "paramType": "path",
                 "dataType": 'int'
-            }]
+            }] + CURSOR_PARAMETERS
     )
     def get(self, web_id, page=1):
-        page = int(page)
-        pagination = WebMonitorLog.query.filter_by(web_id=web_id) \
-            .order_by(db.desc(WebMonitorLog.id)).paginate(page, per_page=10, error_out=False)  # 分页
-        target_web_monitor_logs = pagination.items
-        target_web_monitor_logs_num = pagination.total
-        total_page = pagination.pages
+        target_web_monitor_logs = WebMonitorLog.query.filter_by(web_id=web_id)
+        target_web_monitor_logs_num = page_total(('web_monitor_logs', web_id), target_web_monitor_logs)
+        total_page = total_pages(target_web_monitor_logs_num)
+        target_web_monitor_logs, next_cursor = paginate(target_web_monitor_logs, [(WebMonitorLog.id, True)],
+                                                        lambda target_web_monitor_log: [target_web_monitor_log.id],
+                                                        request.args.get('cursor'), int(page))  # 分页
 
         target_web = WebMonitor.query.filter_by(id=web_id).first()
 
@@ -1257,10 +1535,23 @@ class WebMonitorDetailCtrl(flask_restful.Resource):
         rsts['target_web_monitor_log'] = log
         rsts['total_page'] = total_page
         rsts['total_log_num'] = target_web_monitor_logs_num
+        rsts['next_cursor'] = next_cursor
         rsts['user_name'] = g.user.user_name
         return jsonify(rsts)
 
 
+def date_filters(start_date, end_date):
+    '''
+    daily counts between start_date and end_date, both included
+    '''
+    filters = []
+    if start_date:
+        filters.append(VideoDailyCount.date >= start_date)
+    if end_date:
+        filters.append(VideoDailyCount.date <= end_date)
+    return filters
+
+
 class SpiderResult(flask_restful.Resource):
     @auth.login_required
     @swagger.operation(
@@ -1289,7 +1580,6 @@ class SpiderResult(flask_restful.Resource):
         ]
     )
     def get(self):
-        videos = Videoitems.query
         response = {}
         rst = {}
         today = datetime.date.today()
@@ -1301,24 +1591,25 @@ class SpiderResult(flask_restful.Resource):
         lask_week = today - oneweek
         lask_month = today - onemonth
 
-        total_num = videos.count()
-        videos_increase_by_day = videos.filter(Videoitems.spider_time == yesterday).count()
-        videos_increase_by_week = videos.filter(Videoitems.spider_time.between(lask_week, today)).count()
-        videos_increase_by_month = videos.filter(Videoitems.spider_time.between(lask_month, today)).count()
+        def total_where(condition):
+            return db.func.coalesce(db.func.sum(db.case([(condition, VideoDailyCount.count)], else_=0)), 0)
 
-        # 个任务采集结果统计
-        start_date = request.args.get('start_date')
-        end_date = request.args.get('end_date')
-        if start_date:
-            videos = videos.filter(Videoitems.spider_time >= start_date)
-        if end_date:
-            videos = videos.filter(Videoitems.spider_time <= end_date)
-        job_instances = JobInstance.query.all()
+        total_num, videos_increase_by_day, videos_increase_by_week, videos_increase_by_month = [
+            int(count) for count in db.session.query(
+                db.func.coalesce(db.func.sum(VideoDailyCount.count), 0),
+                total_where(VideoDailyCount.date == yesterday),
+                total_where(VideoDailyCount.date.between(lask_week, today)),
+                total_where(VideoDailyCount.date.between(lask_month, today))).one()]
+
+        # 个任务采集结果统计，一次分组统计所有任务
+        filters = date_filters(parse_date(request.args.get('start_date')), parse_date(request.args.get('end_date')))
         videos_num_by_job = []
-        for job_instance in job_instances:
+        for job_name, videos_num in db.session.query(
+                JobInstance.job_name, db.func.coalesce(db.func.sum(VideoDailyCount.count), 0)).outerjoin(
+            VideoDailyCount, db.and_(VideoDailyCount.task_id == JobInstance.id, *filters)).group_by(
+            JobInstance.id, JobInstance.job_name).order_by(JobInstance.id):
             job_result = {}
-            job_name = job_instance.job_name
-            videos_num = videos.filter_by(task_id=job_instance.id).count()
+            videos_num = int(videos_num)
             job_result['job_name'] = job_name
             job_result['videos_num'] = videos_num
             videos_num_by_job.append(job_result)
@@ -1358,40 +1649,30 @@ class SpiderResult1(flask_restful.Resource):
         }]
     )
     def get(self):
-        videos = Videoitems.query
         response = {}
 
         # 个网站采集结果统计
-        start_date = request.args.get('start_date')
-        end_date = request.args.get('end_date')
-        if start_date:
-            videos = videos.filter(Videoitems.spider_time >= start_date)
-        if end_date:
-            videos = videos.filter(Videoitems.spider_time <= end_date)
+        filters = date_filters(parse_date(request.args.get('start_date')), parse_date(request.args.get('end_date')))
+        # 一次按任务所属网站和采集形式分组统计
+        counts_by_web = defaultdict(dict)
+        for project_id, spider_type, count in db.session.query(
+                JobInstance.project_id, JobInstance.spider_type, db.func.sum(VideoDailyCount.count)).join(
+            VideoDailyCount, VideoDailyCount.task_id == JobInstance.id).filter(*filters).group_by(
+            JobInstance.project_id, JobInstance.spider_type):
+            counts_by_web[project_id][spider_type] = int(count)
         projects = Project.query.all()
         videos_num_by_web = []
         for project in projects:
             web_result = {}
             web_name = project.project_name
-            job_instances = JobInstance.query.filter_by(project_id=project.id)
-            videos_num = 0
-            for job_instance in job_instances:
-                videos_num1 = videos.filter_by(task_id=job_instance.id).count()
-                videos_num += videos_num1
+            counts = counts_by_web.get(project.id, {})
+            videos_num = sum(counts.values())
 
             # 按照关键词采集视频的数量
-            job_instances1 = job_instances.filter_by(spider_type='关键词采集').all()
-            videos_num_by_keywords = 0
-            for job_instance in job_instances1:
-                videos_num1 = videos.filter_by(task_id=job_instance.id).count()
-                videos_num_by_keywords += videos_num1
+            videos_num_by_keywords = counts.get('关键词采集', 0)
 
             # 按照板块采集视频的数量
-            job_instances2 = job_instances.filter_by(spider_type='板块采集').all()
-            videos_num_by_plate = 0
-            for job_instance in job_instances2:
-                videos_num1 = videos.filter_by(task_id=job_instance.id).count()
-                videos_num_by_plate += videos_num1
+            videos_num_by_plate = counts.get('板块采集', 0)
             web_result['videos_num'] = videos_num
             web_result['web_name'] = web_name
             web_result['videos_num_by_keywords'] = videos_num_by_keywords
@@ -1431,28 +1712,23 @@ class SpiderResult2(flask_restful.Resource):
         ]
     )
     def get(self):
-        videos = Videoitems.query
-
-        first_date = videos.order_by(db.asc(Videoitems.spider_time)).first().spider_time
-        first_date = datetime.datetime.strptime(first_date, '%Y-%m-%d')
         today = datetime.datetime.today()
-
-        oneday = datetime.timedelta(days=1)
-        oneweek = datetime.timedelta(weeks=1)
-        onemonth = datetime.timedelta(weeks=4)
+        first_date = db.session.query(db.func.min(VideoDailyCount.date)).scalar()
+        first_date = datetime.datetime.combine(first_date, datetime.time()) if first_date else today
 
         start_date = request.args.get('start_date')
         end_date = request.args.get('end_date')
 
         # 默认取所有的数据
+        start_date = parse_date(start_date)
+        end_date = parse_date(end_date)
+        filters = date_filters(start_date, end_date)
         if start_date:
-            videos = videos.filter(Videoitems.spider_time >= start_date)
-            start_date = datetime.datetime.strptime(start_date, '%Y-%m-%d')
+            start_date = datetime.datetime.combine(start_date, datetime.time())
         else:
             start_date = first_date
         if end_date:
-            videos = videos.filter(Videoitems.spider_time <= end_date)
-            end_date = datetime.datetime.strptime(end_date, '%Y-%m-%d')
+            end_date = datetime.datetime.combine(end_date, datetime.time())
         else:
             end_date = today
         days = (end_date - start_date).days + 1
@@ -1462,145 +1738,56 @@ class SpiderResult2(flask_restful.Resource):
             months = 3
 
         response = {}
-        rsts = {}
+
+        # 一次取出统计区间内每天各任务的数量，按天/周/4周的增量由前缀和相减得到
+        end_day = end_date.date()
+        first_day = end_day - datetime.timedelta(days=max(days, weeks * 7, months * 28, 1) - 1)
+        by_job = defaultdict(list)
+        by_web = defaultdict(list)
+        daily_counts = []
+        for task_id, project_id, date, count in db.session.query(
+                VideoDailyCount.task_id, VideoDailyCount.project_id, VideoDailyCount.date,
+                db.func.sum(VideoDailyCount.count)).filter(
+            VideoDailyCount.date >= first_day, VideoDailyCount.date <= end_day, *filters).group_by(
+            VideoDailyCount.task_id, VideoDailyCount.project_id, VideoDailyCount.date):
+            daily_counts.append((date, int(count)))
+            by_job[task_id].append((date, int(count)))
+            by_web[project_id].append((date, int(count)))
+
+        def increase(counts, day_count_type):
+            '''
+            :return: series by day, by week and by 4 weeks, oldest first
+            '''
+            sums = DailySums(counts, first_day, end_day)
+            return [[{'date': date.strftime('%Y-%m-%d'), 'count': count_type(count)}
+                     for date, count in sums.series(end_day, span, steps)]
+                    for span, steps, count_type in ((1, days, day_count_type), (7, weeks, int), (28, months, int))]
 
         """
         采集结果总量新增情况
         """
-        # 按天统计增量
-        videos_increase_by_day = []
-        for d in range(0, days):
-            rst = {}
-            date = end_date - oneday * d
-            count = videos.filter(Videoitems.spider_time.between(date - oneday, date)).count()
-            rst["date"] = date.strftime('%Y-%m-%d')
-            rst["count"] = str(count)
-            videos_increase_by_day.append(rst)
-
-        # 按周的统计
-        videos_increase_by_week = []
-        for w in range(0, weeks):
-            rst = {}
-            date = end_date - oneweek * w
-            count = videos.filter(Videoitems.spider_time.between(date - oneweek, date)).count()
-            rst['date'] = date.strftime('%Y-%m-%d')
-            rst['count'] = count
-            videos_increase_by_week.append(rst)
-
-        # 按月的统计
-        videos_increase_by_month = []
-        for m in range(0, months):
-            rst = {}
-            date = end_date - onemonth * m
-            count = videos.filter(Videoitems.spider_time.between(date - onemonth, date)).count()
-            rst['date'] = date.strftime('%Y-%m-%d')
-            rst['count'] = count
-            videos_increase_by_month.append(rst)
-        videos_increase_by_day.reverse()
-        videos_increase_by_week.reverse()
-        videos_increase_by_month.reverse()
-        videos_increase = []
-        rsts["videos_increase_by_day"] = videos_increase_by_day
-        rsts['videos_increase_by_week'] = videos_increase_by_week
-        rsts['videos_increase_by_month'] = videos_increase_by_month
-        videos_increase.append(rsts)
+        rsts = {}
+        rsts["videos_increase_by_day"], rsts['videos_increase_by_week'], rsts['videos_increase_by_month'] = \
+            increase(daily_counts, str)
+        videos_increase = [rsts]
         """
         各任务采集结果新增情况
         """
-        job_instances = JobInstance.query.all()
         videos_increase_by_job = []
-        for job_instance in job_instances:
-            job_result = {}
-            job_name = job_instance.job_name
-            videos1 = videos.filter_by(task_id=job_instance.id)
-            # 按日统计增量
-            videos_increase_by_job_day = []
-            for d in range(0, days):
-                rst = {}
-                date = end_date - oneday * d
-                count = videos1.filter(Videoitems.spider_time.between(date - oneday, date)).count()
-                rst["date"] = date.strftime('%Y-%m-%d')
-                rst["count"] = str(count)
-                videos_increase_by_job_day.append(rst)
-            # 按周的统计
-            videos_increase_by_job_week = []
-            for w in range(0, weeks):
-                rst = {}
-                date = end_date - oneweek * w
-                count = videos1.filter(Videoitems.spider_time.between(date - oneweek, date)).count()
-                rst['date'] = date.strftime('%Y-%m-%d')
-                rst['count'] = count
-                videos_increase_by_job_week.append(rst)
-
-            # 按月的统计
-            videos_increase_by_job_month = []
-            for m in range(0, months):
-                rst = {}
-                date = end_date - onemonth * m
-                count = videos1.filter(Videoitems.spider_time.between(date - onemonth, date)).count()
-                rst['date'] = date.strftime('%Y-%m-%d')
-                rst['count'] = count
-                videos_increase_by_job_month.append(rst)
-            videos_increase_by_job_day = list(reversed(videos_increase_by_job_day))
-            videos_increase_by_job_week = list(reversed(videos_increase_by_job_week))
-            videos_increase_by_job_month = list(reversed(videos_increase_by_job_month))
-
-            job_result['job_name'] = job_name
-            job_result['videos_increase_by_job_day'] = videos_increase_by_job_day
-            job_result['videos_increase_by_job_week'] = videos_increase_by_job_week
-            job_result['videos_increase_by_job_month'] = videos_increase_by_job_month
+        for job_instance in JobInstance.query.all():
+            job_result = {'job_name': job_instance.job_name}
+            job_result['videos_increase_by_job_day'], job_result['videos_increase_by_job_week'], \
+                job_result['videos_increase_by_job_month'] = increase(by_job[job_instance.id], str)
             videos_increase_by_job.append(job_result)
 
         """
         各网站采集结果新增情况
         """
-        projects = Project.query.all()
         videos_increase_by_web = []
-        for project in projects:
-            web_result = {}
-            web_name = project.project_name
-            job_instances = JobInstance.query.filter_by(project_id=project.id).all()  # 面向单个网站所有的任务
-            task_ids = []
-            for job_instance in job_instances:  # 单个任务下分时段统计
-                task_ids.append(job_instance.id)
-            videos2 = videos.filter(Videoitems.task_id.in_(task_ids))
-            # 按日统计增量
-            videos_increase_by_web_day = []
-            for d in range(0, days):
-                rst = {}
-                date = end_date - oneday * d
-                count = videos2.filter(Videoitems.spider_time.between(date - oneday, date)).count()
-                rst["date"] = date.strftime('%Y-%m-%d')
-                rst["count"] = count
-                print(count)
-                videos_increase_by_web_day.append(rst)
-
-            # 按周的统计
-            videos_increase_by_web_week = []
-            for w in range(0, weeks):
-                rst = {}
-                date = end_date - oneweek * w
-                count = videos2.filter(Videoitems.spider_time.between(date - oneweek, date)).count()
-                rst['date'] = date.strftime('%Y-%m-%d')
-                rst['count'] = count
-                videos_increase_by_web_week.append(rst)
-
-            # 按月的统计
-            videos_increase_by_web_month = []
-            for m in range(0, months):
-                rst = {}
-                date = end_date - onemonth * m
-                count = videos2.filter(Videoitems.spider_time.between(date - onemonth, date)).count()
-                rst['date'] = date.strftime('%Y-%m-%d')
-                rst['count'] = count
-                videos_increase_by_web_month.append(rst)
-            videos_increase_by_web_day = list(reversed(videos_increase_by_web_day))
-            videos_increase_by_web_week = list(reversed(videos_increase_by_web_week))
-            videos_increase_by_web_month = list(reversed(videos_increase_by_web_month))
-            web_result['web_name'] = web_name
-            web_result['videos_increase_by_web_day'] = videos_increase_by_web_day
-            web_result['videos_increase_by_web_week'] = videos_increase_by_web_week
-            web_result['videos_increase_by_web_month'] = videos_increase_by_web_month
+        for project in Project.query.all():
+            web_result = {'web_name': project.project_name}
+            web_result['videos_increase_by_web_day'], web_result['videos_increase_by_web_week'], \
+                web_result['videos_increase_by_web_month'] = increase(by_web[project.id], int)
             videos_increase_by_web.append(web_result)
 
         response["videos_increase"] = videos_increase
@@ -1610,6 +1797,30 @@ class SpiderResult2(flask_restful.Resource):
         return jsonify(response)
 
 
+class ServerStatsCtrl(flask_restful.Resource):
+    @auth.login_required
+    @swagger.operation(
+        summary='服务器连接统计',
+        parameters=[{
+            "name": "username_or_token",
+            "description": "token",
+            "required": True,
+            "paramType": "header",
+            "dataType": 'string'
+        }]
+    )
+    def get(self):
+        rsts = []
+        for server in agent.servers:
+            rst = {
+                'server': server,
+                'http': get_client(server).stats(),
+                'load': agent.get_daemon_status().get(server),
+            }
+            rsts.append(rst)
+        return jsonify({'rst': rsts, 'code': 200, 'user_name': g.user.user_name})
+
+
 # api.add_resource(ProjectCtrl, "/api/projects")
 # api.add_resource(SpiderCtrl, "/api/projects/<project_id>/spiders")
 # api.add_resource(SpiderDetailCtrl, "/api/projects/<project_id>/spiders/<spider_id>")
@@ -1620,13 +1831,18 @@ api.add_resource(JobSCtrl, "/api/joblist")  # 任务列表
 api.add_resource(JobDetail, "/api/joblist/<job_id>")  # 任务详情
 api.add_resource(JobDetailCtrl, "/api/project/update_jobs/<job_id>")  # 任务更新
 api.add_resource(VideosCtrl, "/api/joblist/videos/<page>")  # 视频列表
+api.add_resource(VideoSearchCtrl, "/api/videos/search")  # 视频标题搜索
 api.add_resource(VideoDetail, "/api/joblist/video_detail/<video_id>")  # 视频详情
 api.add_resource(JobExecutionCtrl, "/api/job_executions/<page>")  # 任务执行列表
+api.add_resource(JobExecutionLogCtrl, "/api/job_executions/<job_exec_id>/log")  # 任务执行日志
+api.add_resource(JobLogSearchCtrl, "/api/job_executions/log/search")  # 任务日志搜索
+api.add_resource(JobStatsCtrl, "/api/job_stats")  # 爬取速率统计
 api.add_resource(SpiderResult, "/api/spider_result/total/by_job")  # 采集结果统计---各个任务的统计
 api.add_resource(SpiderResult1, "/api/spider_result/total/by_web")  # 采集结果统计---各个网站的统计
 api.add_resource(SpiderResult2, "/api/spider_result/total/new_increase")  # 采集结果统计---新增结果统计
 api.add_resource(WebMonitorCtrl, "/api/web_monitor/<page>")  # 网站监控列表
 api.add_resource(WebMonitorDetailCtrl, "/api/web_monitor/<web_id>/<page>")  # 网站监控日志
+api.add_resource(ServerStatsCtrl, "/api/servers/stats")  # 服务器连接统计
 # api.add_resource(JobExecutionCtrl, "/api/projects/<project_id>/jobexecs")
 # api.add_resource(JobExecutionDetailCtrl, "/api/projects/<project_id>/jobexecs/<job_exec_id>")
 
@@ -1728,6 +1944,7 @@ def project_create():
 def project_delete(project_id):
     project = Project.find_project_by_id(project_id)
     agent.delete_project(project)
+    EggDeployment.delete_project(project.id)
     db.session.delete(project)
     db.session.commit()
     return redirect("/project/manage", code=302)
@@ -1802,13 +2019,63 @@ def job_stop(project_id, job_exec_id):
     return redirect(request.referrer, code=302)
 
 
+def read_job_log(job_execution, tail=None, offset=None, length=None):
+    '''
+    read a slice of a job log with an http range request, only whole lines are returned
+    :param job_execution:
+    :param tail: KB at the end of the log, used when no offset is given
+    :param offset: first byte, pass the last next_offset to follow a running job
+    :param length: max bytes from offset
+    :return: dict(lines, offset, next_offset, size), None if the log could not be read
+    '''
+    try:
+        if offset is None:
+            chunk = agent.read_log(job_execution, -1024 * (tail or app.config.get('LOG_TAIL_KB', 64)))
+        else:
+            chunk = agent.read_log(job_execution, max(offset, 0), length or app.config.get('LOG_PAGE_SIZE'))
+    except IOError as e:
+        app.logger.warning('[read_job_log] %s' % str(e))
+        return None
+    if chunk is None:
+        return None
+    data, start, end = chunk['data'], chunk['offset'], chunk['next_offset']
+    # a tail starts inside a line
+    if offset is None and start > 0:
+        cut = data.find(b'\n') + 1
+        data, start = data[cut:], start + cut
+    # a page ends inside a line, and a running job may still be writing its last line,
+    # the next read starts at the beginning of that line
+    at_end = end >= chunk['size']
+    if data and not data.endswith(b'\n') and (not at_end or job_execution.running_status == SpiderStatus.RUNNING):
+        cut = data.rfind(b'\n') + 1
+        if cut or at_end:
+            data, end = data[:cut], start + cut
+    return dict(lines=data.decode('utf8', 'replace').splitlines(), offset=start, next_offset=end,
+                size=chunk['size'])
+
+
 @app.route("/project/<project_id>/jobexecs/<job_exec_id>/log")
 def job_log(project_id, job_exec_id):
     job_execution = JobExecution.query.filter_by(project_id=project_id, id=job_exec_id).first()
-    res = requests.get(agent.log_url(job_execution))
-    res.encoding = 'utf8'
-    raw = res.text
-    return render_template("job_log.html", log_lines=raw.split('\n'))
+    log = read_job_log(job_execution, request.args.get('tail', type=int), request.args.get('offset', type=int),
+                       request.args.get('length', type=int))
+    if log is None:
+        return render_template("job_log.html", log_lines=['log not found'], offset=0, next_offset=0, size=0)
+    return render_template("job_log.html", log_lines=log['lines'], offset=log['offset'],
+                           next_offset=log['next_offset'], size=log['size'],
+                           prev_offset=max(log['offset'] - app.config.get('LOG_PAGE_SIZE'), 0),
+                           follow=job_execution.running_status == SpiderStatus.RUNNING)
+
+
+@app.route("/project/<project_id>/jobexecs/<job_exec_id>/log/range")
+def job_log_range(project_id, job_exec_id):
+    job_execution = JobExecution.query.filter_by(project_id=project_id, id=job_exec_id).first()
+    log = read_job_log(job_execution, request.args.get('tail', type=int), request.args.get('offset', type=int),
+                       request.args.get('length', type=int))
+    if log is not None:
+        # the page stops following once a finished job has no more lines
+        log['running'] = job_execution.running_status == SpiderStatus.RUNNING
+    return jsonify({'rst': log, 'code': 200 if log is not None else 404})
 
 
 @app.route("/project/<project_id>/job/<job_instance_id>/run")
@@ -1844,7 +2111,9 @@ def spider_dashboard(project_id):
 @app.route("/project/<project_id>/spider/deploy")
 def spider_deploy(project_id):
     project = Project.find_project_by_id(project_id)
-    return render_template("spider_deploy.html")
+    project_egg = ProjectEgg.current(project.id)
+    pending_servers = EggDeployment.pending_servers(project_egg, agent.servers) if project_egg else []
+    return render_template("spider_deploy.html", pending_servers=pending_servers)
 
 
 @app.route("/project/<project_id>/spider/upload", methods=['post'])
@@ -1860,14 +2129,46 @@ def spider_egg_upload(project_id):
         flash('No selected file')
         return redirect(request.referrer)
     if file:
-        filename = secure_filename(file.filename)
-        dst = os.path.join(tempfile.gettempdir(), filename)
+        fd, dst = tempfile.mkstemp(prefix='%s-' % project.project_name, suffix='-' + secure_filename(file.filename))
+        os.close(fd)
         file.save(dst)
-        agent.deploy(project, dst)
-        flash('deploy success!')
+        # identical eggs share one file in the store and keep their version
+        egg_hash, egg_file = store_egg(app.config.get('EGG_STORE_DIR'), dst)
+        project_egg = ProjectEgg.current(project.id)
+        if not project_egg or project_egg.egg_hash != egg_hash:
+            # scrapyd runs the highest version, a new egg must never reuse or go below the current one
+            version = max(int(time.time()), int(project_egg.version) + 1 if project_egg else 0)
+            project_egg = ProjectEgg.add(project.id, egg_hash, version)
+        _deploy_egg(project, project_egg)
     return redirect(request.referrer)
 
 
+@app.route("/project/<project_id>/spider/upload/retry", methods=['post'])
+def spider_egg_retry(project_id):
+    project = Project.find_project_by_id(project_id)
+    project_egg = ProjectEgg.current(project.id)
+    if not project_egg:
+        flash('No egg uploaded')
+        return redirect(request.referrer)
+    _deploy_egg(project, project_egg)
+    return redirect(request.referrer)
+
+
+def _deploy_egg(project, project_egg):
+    '''
+    deploy the egg from the store to the daemons that have not got it, flash the result of each daemon
+    '''
+    servers = EggDeployment.pending_servers(project_egg, agent.servers)
+    if not servers:
+        flash('egg unchanged, already deployed on every daemon')
+        return
+    deploy_result = agent.deploy(project, egg_path(app.config.get('EGG_STORE_DIR'), project_egg.egg_hash),
+                                 servers=servers, version=project_egg.version)
+    EggDeployment.record(project_egg, [server for server, ok in deploy_result.items() if ok])
+    for server in sorted(deploy_result):
+        flash('deploy to %s %s' % (server, 'success!' if deploy_result[server] else 'failed'))
+
+
 @app.route("/project/<project_id>/project/stats")
 def project_stats(project_id):
     project = Project.find_project_by_id(project_id)
@@ -1879,4 +2180,10 @@ def project_stats(project_id):
 def service_stats(project_id):
     project = Project.find_project_by_id(project_id)
     run_stats = JobExecution.list_run_stats_by_hours(project_id)
-    return render_template("server_stats.html", run_stats=run_stats)
+    status_names = {SpiderStatus.PENDING: 'pending', SpiderStatus.RUNNING: 'running',
+                    SpiderStatus.FINISHED: 'finished', SpiderStatus.CANCELED: 'canceled'}
+    run_stats_by_daemon = JobExecution.list_run_stats_by_hours_and_daemon(project_id)
+    run_stats_by_status = [(status_names.get(status, status), stats) for status, stats in
+                           JobExecution.list_run_stats_by_hours_and_status(project_id)]
+    return render_template("server_stats.html", run_stats=run_stats, run_stats_by_daemon=run_stats_by_daemon,
+                           run_stats_by_status=run_stats_by_status, daemon_status=agent.get_daemon_status())
@@ -1,10 +1,14 @@
 import datetime
 import json
 
-from sqlalchemy import desc
+from sqlalchemy import desc, event, inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, foreign, object_session
 
 
 from SpiderKeeper.app import db, Base, app
+from SpiderKeeper.app.util import fulltext
+from SpiderKeeper.app.util.cache import TTLCache
 from werkzeug.security import generate_password_hash,check_password_hash
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer, SignatureExpired, BadSignature
 
@@ -16,11 +20,12 @@ class Project(Base):
 
     @classmethod
     def load_project(cls, project_list):   # 添加工程
-        for project in project_list:
-            existed_project = cls.query.filter_by(project_name=project.project_name).first()
-            if not existed_project:
-                db.session.add(project)
-                db.session.commit()
+        existed_project_names = set(project_name for project_name, in db.session.query(cls.project_name))
+        new_project_names = set(project.project_name for project in project_list).difference(existed_project_names)
+        if new_project_names:
+            db.session.bulk_insert_mappings(cls, [dict(project_name=project_name)
+                                                  for project_name in new_project_names])
+        db.session.commit()
 
     @classmethod
     def find_project_by_id(cls, project_id):   # 查询工程
@@ -40,22 +45,23 @@ class SpiderInstance(Base):
     project_id = db.Column(db.INTEGER, nullable=False, index=True)
 
     @classmethod
-    def update_spider_instances(cls, project_id, spider_instance_list):
-        for spider_instance in spider_instance_list:
-            existed_spider_instance = cls.query.filter_by(project_id=project_id,
-                                                          spider_name=spider_instance.spider_name).first()
-            if not existed_spider_instance:
-                db.session.add(spider_instance)
-                db.session.commit()
-
-        for spider in cls.query.filter_by(project_id=project_id).all():
-            existed_spider = any(
-                spider.spider_name == s.spider_name
-                for s in spider_instance_list
-            )
-            if not existed_spider:
-                db.session.delete(spider)
-                db.session.commit()
+    def update_spider_instances(cls, project_id, spider_instance_list, remove_missing=True):
+        '''
+        :param spider_instance_list: spiders reported by the daemons
+        :param remove_missing: delete the spiders of the project that are not in the list
+        '''
+        existed_spider_names = set(spider_name for spider_name, in
+                                   db.session.query(cls.spider_name).filter_by(project_id=project_id))
+        spider_names = set(spider_instance.spider_name for spider_instance in spider_instance_list)
+        new_spider_names = spider_names.difference(existed_spider_names)
+        removed_spider_names = existed_spider_names.difference(spider_names)
+        if new_spider_names:
+            db.session.bulk_insert_mappings(cls, [dict(project_id=project_id, spider_name=spider_name)
+                                                  for spider_name in new_spider_names])
+        if removed_spider_names and remove_missing:
+            cls.query.filter(cls.project_id == project_id,
+                             cls.spider_name.in_(removed_spider_names)).delete(synchronize_session=False)
+        db.session.commit()
 
     @classmethod
     def list_spider_by_project_id(cls, project_id):
@@ -96,6 +102,83 @@ class SpiderInstance(Base):
         return res
 
 
+class ProjectEgg(Base):
+    __tablename__ = 'project_egg'
+    '''工程上传过的egg, 最新一条为当前版本'''
+    project_id = db.Column(db.INTEGER, nullable=False, index=True)
+    egg_hash = db.Column(db.String(64), nullable=False)
+    version = db.Column(db.String(50), nullable=False)
+
+    @classmethod
+    def current(cls, project_id):
+        return cls.query.filter_by(project_id=project_id).order_by(desc(cls.id)).first()
+
+    @classmethod
+    def list_current(cls):
+        '''
+        :return: current egg of every project
+        '''
+        latest_ids = db.session.query(db.func.max(cls.id)).group_by(cls.project_id)
+        return cls.query.filter(cls.id.in_(latest_ids.subquery())).all()
+
+    @classmethod
+    def add(cls, project_id, egg_hash, version):
+        project_egg = cls(project_id=project_id, egg_hash=egg_hash, version=str(version))
+        db.session.add(project_egg)
+        db.session.commit()
+        return project_egg
+
+
+class EggDeployment(Base):
+    __tablename__ = 'egg_deployment'
+    '''各服务器上部署的egg'''
+    project_id = db.Column(db.INTEGER, nullable=False, index=True)
+    server = db.Column(db.String(100), nullable=False)
+    egg_hash = db.Column(db.String(64), nullable=False)
+    version = db.Column(db.String(50), nullable=False)
+
+    @classmethod
+    def deployed_hashes(cls, project_id):
+        '''
+        :return: {server: egg_hash}
+        '''
+        return dict(db.session.query(cls.server, cls.egg_hash).filter_by(project_id=project_id))
+
+    @classmethod
+    def pending_servers(cls, project_egg, servers):
+        '''
+        :param project_egg: current egg of the project
+        :param servers: all daemons
+        :return: daemons which have not got the egg
+        '''
+        deployed_hashes = cls.deployed_hashes(project_egg.project_id)
+        return [server for server in servers if deployed_hashes.get(server) != project_egg.egg_hash]
+
+    @classmethod
+    def record(cls, project_egg, servers):
+        if not servers:
+            return
+        deployments = dict((deployment.server, deployment) for deployment in
+                           cls.query.filter(cls.project_id == project_egg.project_id, cls.server.in_(servers)))
+        for server in servers:
+            deployment = deployments.get(server)
+            if deployment is None:
+                deployment = cls(project_id=project_egg.project_id, server=server)
+                db.session.add(deployment)
+            deployment.egg_hash = project_egg.egg_hash
+            deployment.version = project_egg.version
+        db.session.commit()
+
+    @classmethod
+    def delete_project(cls, project_id):
+        cls.query.filter_by(project_id=project_id).delete(synchronize_session=False)
+        ProjectEgg.query.filter_by(project_id=project_id).delete(synchronize_session=False)
+
+
+# dropdown lookups shared by the list apis
+lookup_cache = TTLCache(app.config.get('LOOKUP_CACHE_TTL', 300))
+
+
 class JobPriority():
     LOW, NORMAL, HIGH, HIGHEST = range(-1, 3)
 
@@ -189,6 +272,16 @@ class JobInstance(Base):
     def find_job_instance_by_id(cls, job_instance_id):
         return cls.query.filter_by(id=job_instance_id).first()
 
+    @classmethod
+    def list_job_names(cls):
+        '''
+        job dropdown, cached until a job instance changes
+        :return: [{'job_name':..,'job_id':..}]
+        '''
+        return lookup_cache.get('job_names', lambda: [
+            {'job_name': job_name, 'job_id': job_id}
+            for job_id, job_name in db.session.query(cls.id, cls.job_name).order_by(cls.id)])
+
 
 class SpiderStatus():
     PENDING, RUNNING, FINISHED, CANCELED = range(4)
@@ -205,9 +298,16 @@ class JobExecution(Base):
     end_time = db.Column(db.DATETIME)
     running_status = db.Column(db.INTEGER, default=SpiderStatus.PENDING)
     running_on = db.Column(db.Text)
+    # 按小时统计工程的执行次数
+    __table_args__ = (
+        db.Index('ix_job_execution_project_id_create_time', 'project_id', 'create_time'),
+    )
+    # no foreign key in the schema, the join is declared here; eager load it when serializing many rows
+    job_instance = db.relationship(JobInstance, uselist=False, viewonly=True,
+                                   primaryjoin=lambda: foreign(JobExecution.job_instance_id) == JobInstance.id)
 
     def to_dict(self):
-        job_instance = JobInstance.query.filter_by(id=self.job_instance_id).first()
+        job_instance = self.job_instance
         return {
             'project_id': self.project_id,
             'job_execution_id': self.id,
@@ -234,40 +334,246 @@ class JobExecution(Base):
         return cls.query.filter(cls.running_status != SpiderStatus.FINISHED,
                                 cls.running_status != SpiderStatus.CANCELED).all()
 
+    @classmethod
+    def index_uncomplete_job(cls):
+        '''
+        unfinished executions keyed by the daemon they run on and their service job id
+        :return: {(running_on, service_job_execution_id): (job_execution_id, running_status)}
+        '''
+        rows = db.session.query(cls.id, cls.running_on, cls.service_job_execution_id, cls.running_status).filter(
+            cls.running_status != SpiderStatus.FINISHED, cls.running_status != SpiderStatus.CANCELED)
+        return dict(((running_on, service_job_execution_id), (job_execution_id, running_status))
+                    for job_execution_id, running_on, service_job_execution_id, running_status in rows)
+
+    @classmethod
+    def index_complete_job(cls, service_job_execution_ids):
+        '''
+        :param service_job_execution_ids:
+        :return: {(running_on, service_job_execution_id)} of these jobs already finished or canceled
+        '''
+        if not service_job_execution_ids:
+            return set()
+        return set(db.session.query(cls.running_on, cls.service_job_execution_id).filter(
+            cls.service_job_execution_id.in_(service_job_execution_ids),
+            cls.running_status.in_([SpiderStatus.FINISHED, SpiderStatus.CANCELED])))
+
+    @classmethod
+    def update_job_status(cls, job_status_list):
+        '''
+        write one status transition as a single executemany UPDATE
+        :param job_status_list: [{'id':..,'running_status':..,'start_time':..,'end_time':..}]
+        '''
+        if job_status_list:
+            db.session.bulk_update_mappings(cls, job_status_list)
+
     @classmethod
     def list_jobs(cls, project_id, each_status_limit=100):
+        '''
+        latest executions of each state, one query per state with the job instances joined in
+        '''
+        query = cls.query.options(joinedload(cls.job_instance)).filter(cls.project_id == project_id).order_by(
+            desc(cls.date_modified))
         result = {}
         result['PENDING'] = [job_execution.to_dict() for job_execution in
-                             JobExecution.query.filter_by(project_id=project_id,
-                                                          running_status=SpiderStatus.PENDING).order_by(
-                                 desc(JobExecution.date_modified)).limit(each_status_limit)]
+                             query.filter(cls.running_status == SpiderStatus.PENDING).limit(each_status_limit)]
         result['RUNNING'] = [job_execution.to_dict() for job_execution in
-                             JobExecution.query.filter_by(project_id=project_id,
-                                                          running_status=SpiderStatus.RUNNING).order_by(
-                                 desc(JobExecution.date_modified)).limit(each_status_limit)]
+                             query.filter(cls.running_status == SpiderStatus.RUNNING).limit(each_status_limit)]
         result['COMPLETED'] = [job_execution.to_dict() for job_execution in
-                               JobExecution.query.filter(JobExecution.project_id == project_id).filter(
-                                   (JobExecution.running_status == SpiderStatus.FINISHED) | (
-                                       JobExecution.running_status == SpiderStatus.CANCELED)).order_by(
-                                   desc(JobExecution.date_modified)).limit(each_status_limit)]
+                               query.filter(cls.running_status.in_([SpiderStatus.FINISHED,
+                                                                    SpiderStatus.CANCELED])).limit(each_status_limit)]
         return result
 
+    @classmethod
+    def _count_by_hours(cls, project_id, *group_by):
+        '''
+        executions created in each of the last 24 hours, counted by the database
+        :param project_id:
+        :param group_by: columns counted separately
+        :return: (hour keys oldest first, {(group values) + (hour key,): count})
+        '''
+        now = datetime.datetime.now()
+        hour_keys = [(now - datetime.timedelta(hours=hour)).strftime('%Y-%m-%d %H:00:00') for hour in range(23, -1, -1)]
+        last_time = datetime.datetime.strptime(hour_keys[0], '%Y-%m-%d %H:00:00')
+        hour_key = _hour_key(cls.create_time)
+        keys = list(group_by) + [hour_key]
+        counts = dict((tuple(row[:-1]), row[-1]) for row in db.session.query(*(keys + [db.func.count(cls.id)])).filter(
+            cls.project_id == project_id, cls.create_time >= last_time).group_by(*keys))
+        return hour_keys, counts
+
     @classmethod
     def list_run_stats_by_hours(cls, project_id):
-        result = {}
-        hour_keys = []
-        last_time = datetime.datetime.now() - datetime.timedelta(hours=23)
-        last_time = datetime.datetime(last_time.year, last_time.month, last_time.day, last_time.hour)
-        for hour in range(23, -1, -1):
-            time_tmp = datetime.datetime.now() - datetime.timedelta(hours=hour)
-            hour_key = time_tmp.strftime('%Y-%m-%d %H:00:00')
-            hour_keys.append(hour_key)
-            result[hour_key] = 0  # init
-        for job_execution in JobExecution.query.filter(JobExecution.project_id == project_id,
-                                                       JobExecution.date_created >= last_time).all():
-            hour_key = job_execution.create_time.strftime('%Y-%m-%d %H:00:00')
-            result[hour_key] += 1
-        return [dict(key=hour_key, value=result[hour_key]) for hour_key in hour_keys]
+        hour_keys, counts = cls._count_by_hours(project_id)
+        return [dict(key=hour_key, value=counts.get((hour_key,), 0)) for hour_key in hour_keys]
+
+    @classmethod
+    def list_run_stats_by_hours_and_daemon(cls, project_id):
+        '''
+        :return: [(daemon, [dict(key=hour, value=count)])]
+        '''
+        return cls._list_run_stats_by_hours_and(project_id, cls.running_on)
+
+    @classmethod
+    def list_run_stats_by_hours_and_status(cls, project_id):
+        '''
+        :return: [(running status, [dict(key=hour, value=count)])]
+        '''
+        return cls._list_run_stats_by_hours_and(project_id, cls.running_status)
+
+    @classmethod
+    def _list_run_stats_by_hours_and(cls, project_id, column):
+        hour_keys, counts = cls._count_by_hours(project_id, column)
+        groups = sorted(set(group for group, _ in counts), key=lambda group: (group is None, group))
+        return [(group, [dict(key=hour_key, value=counts.get((group, hour_key), 0)) for hour_key in hour_keys])
+                for group in groups]
+
+
+def _hour_key(column):
+    '''
+    :return: the hour of a datetime column as 'YYYY-mm-dd HH:00:00', computed by the database
+    '''
+    dialect = db.engine.dialect.name
+    if dialect == 'mysql':
+        return db.func.date_format(column, '%Y-%m-%d %H:00:00')
+    if dialect == 'postgresql':
+        return db.func.to_char(column, 'YYYY-MM-DD HH24:00:00')
+    return db.func.strftime('%Y-%m-%d %H:00:00', column)
+
+
+class JobLogMirror(Base):
+    __tablename__ = 'job_log_mirror'
+    '''已复制到本地的任务日志'''
+    job_execution_id = db.Column(db.INTEGER, nullable=False, unique=True)
+    size = db.Column(db.BigInteger, default=0)
+    line_count = db.Column(db.INTEGER, default=0)
+
+    @classmethod
+    def list_unmirrored(cls, servers, limit):
+        '''
+        :param servers: daemons the logs can be read from
+        :param limit:
+        :return: [JobExecution] finished on these daemons and not mirrored yet, newest first
+        '''
+        if not servers:
+            return []
+        return JobExecution.query.outerjoin(cls, cls.job_execution_id == JobExecution.id).filter(
+            cls.id == None,
+            JobExecution.running_status.in_([SpiderStatus.FINISHED, SpiderStatus.CANCELED]),
+            JobExecution.running_on.in_(servers)).order_by(desc(JobExecution.id)).limit(limit).all()
+
+    @classmethod
+    def list_job_execution_ids(cls, job_instance_id):
+        return [job_execution_id for job_execution_id, in db.session.query(cls.job_execution_id).join(
+            JobExecution, cls.job_execution_id == JobExecution.id).filter(
+            JobExecution.job_instance_id == job_instance_id).order_by(desc(cls.job_execution_id))]
+
+    @classmethod
+    def add(cls, job_execution_id, size, line_count):
+        '''
+        :return: False if another process mirrored the log first
+        '''
+        db.session.add(cls(job_execution_id=job_execution_id, size=size, line_count=line_count))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return False
+        return True
+
+
+class JobExecutionStats(Base):
+    __tablename__ = 'job_execution_stats'
+    '''任务执行结束时scrapy输出的统计'''
+    job_execution_id = db.Column(db.INTEGER, nullable=False, unique=True)
+    job_instance_id = db.Column(db.INTEGER, nullable=False, index=True)
+    start_time = db.Column(db.DATETIME, index=True)
+    elapsed = db.Column(db.Float)                       # 运行秒数
+    item_count = db.Column(db.INTEGER, default=0)       # item_scraped_count
+    item_dropped_count = db.Column(db.INTEGER, default=0)
+    request_count = db.Column(db.INTEGER, default=0)    # downloader/request_count
+    response_count = db.Column(db.INTEGER, default=0)   # downloader/response_count
+    error_count = db.Column(db.INTEGER, default=0)      # log_count/ERROR
+    warning_count = db.Column(db.INTEGER, default=0)    # log_count/WARNING
+    finish_reason = db.Column(db.String(50))            # 日志中没有统计时为空
+
+    @classmethod
+    def list_unparsed(cls, limit):
+        '''
+        :return: [JobExecution] whose log is mirrored and whose stats are not parsed yet
+        '''
+        return JobExecution.query.join(JobLogMirror, JobLogMirror.job_execution_id == JobExecution.id).outerjoin(
+            cls, cls.job_execution_id == JobExecution.id).filter(cls.id == None).order_by(
+            desc(JobExecution.id)).limit(limit).all()
+
+    @classmethod
+    def add(cls, job_execution, stats, elapsed):
+        '''
+        :param job_execution:
+        :param stats: parsed scrapy stats, None if the log has none
+        :param elapsed: run time in seconds
+        :return: False if another process added the stats first
+        '''
+        stats = stats or {}
+        start_time = stats.get('start_time')
+        db.session.add(cls(job_execution_id=job_execution.id,
+                           job_instance_id=job_execution.job_instance_id,
+                           start_time=start_time if isinstance(start_time, datetime.datetime)
+                           else job_execution.start_time,
+                           elapsed=elapsed,
+                           item_count=stats.get('item_scraped_count', 0),
+                           item_dropped_count=stats.get('item_dropped_count', 0),
+                           request_count=stats.get('downloader/request_count', 0),
+                           response_count=stats.get('downloader/response_count', 0),
+                           error_count=stats.get('log_count/ERROR', 0),
+                           warning_count=stats.get('log_count/WARNING', 0),
+                           finish_reason=stats.get('finish_reason')))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return False
+        return True
+
+    @classmethod
+    def throughput(cls, group_by, start_date=None, end_date=None, by_day=False):
+        '''
+        items/sec and requests/sec of runs with stats
+        :param group_by: spider, daemon or job
+        :param start_date: runs started on or after
+        :param end_date: runs started before
+        :param by_day: also group by the day a run started
+        :return: [dict]
+        '''
+        key = {'spider': JobInstance.spider_name,
+               'daemon': JobExecution.running_on,
+               'job': cls.job_instance_id}[group_by]
+        keys = [key] + ([db.func.date(cls.start_time)] if by_day else [])
+        query = db.session.query(*(keys + [db.func.count(cls.id), db.func.sum(cls.elapsed),
+                                           db.func.sum(cls.item_count), db.func.sum(cls.request_count),
+                                           db.func.sum(cls.error_count)])).select_from(cls).join(
+            JobExecution, JobExecution.id == cls.job_execution_id).join(
+            JobInstance, JobInstance.id == cls.job_instance_id).filter(cls.elapsed > 0)
+        if start_date:
+            query = query.filter(cls.start_time >= start_date)
+        if end_date:
+            query = query.filter(cls.start_time < end_date)
+        result = []
+        for row in query.group_by(*keys).order_by(*keys):
+            executions, elapsed, items, requests, errors = row[-5:]
+            # mysql sums integers to Decimal, which does not divide by a float
+            elapsed = float(elapsed)
+            item = {group_by: row[0],
+                    'executions': executions,
+                    'elapsed': round(elapsed, 3),
+                    'items': int(items),
+                    'requests': int(requests),
+                    'errors': int(errors),
+                    'items_per_sec': round(float(items) / elapsed, 3),
+                    'requests_per_sec': round(float(requests) / elapsed, 3)}
+            if by_day:
+                item['date'] = str(row[1])
+            result.append(item)
+        return result
+
 
 class Videoitems(db.Model):
     __tablename__ = 'videoitems'
@@ -278,15 +584,171 @@ class Videoitems(db.Model):
     keywords = db.Column(db.String(100), nullable=False)
     tags = db.Column(db.String(1000), default=[])
     video_category = db.Column(db.String(50), default="其它")
-    upload_time = db.Column(db.String(50))
-    spider_time = db.Column(db.String(50))
+    upload_time = db.Column(db.DATETIME)
+    spider_time = db.Column(db.Date, index=True)
     info = db.Column(db.Text)
     site_name = db.Column(db.String(20), default="")
     video_time = db.Column(db.Integer, default=0)
     isdownload = db.Column(db.Integer, default=0)
     play_count = db.Column(db.String(20), default="0")
-    task_id = db.Column(db.String(20))
+    task_id = db.Column(db.INTEGER)  # 作业实例ID
     lg = db.Column(db.String(40))
+    # 按任务/网站统计某段时间的采集结果
+    __table_args__ = (
+        db.Index('ix_videoitems_task_id_spider_time', 'task_id', 'spider_time'),
+        db.Index('ix_videoitems_site_name_spider_time', 'site_name', 'spider_time'),
+    )
+
+    # dialect whose full text index of titles is ready, set by init_title_index
+    title_index = None
+
+    @classmethod
+    def _use_title_index(cls, text):
+        return cls.title_index is not None and len(text) >= fulltext.MIN_QUERY_LENGTH[cls.title_index]
+
+    @classmethod
+    def title_filter(cls, text):
+        '''
+        :param text:
+        :return: where clause for videos whose title or title_cn contains text, served by the full text index
+                 when the text is long enough for it
+        '''
+        if cls._use_title_index(text) and cls.title_index == 'mysql':
+            return db.text(fulltext.MYSQL_MATCH).bindparams(title_phrase=fulltext.phrase(text, 'mysql'))
+        if cls._use_title_index(text):
+            return cls.id.in_(db.text(fulltext.SQLITE_MATCH).bindparams(
+                title_phrase=fulltext.phrase(text, 'sqlite')).columns(db.column('rowid')))
+        return db.or_(cls.title.contains(text), cls.title_cn.contains(text))
+
+    @classmethod
+    def search_titles(cls, text, limit=20):
+        '''
+        videos ranked by how well their titles match text
+        :param text:
+        :param limit:
+        :return: [(Videoitems, score)], score is None when the text is too short for the index
+        '''
+        if not cls._use_title_index(text):
+            return [(video, None) for video in
+                    cls.query.filter(cls.title_filter(text)).order_by(desc(cls.id)).limit(limit)]
+        if cls.title_index == 'mysql':
+            rows = db.session.execute(db.text(fulltext.MYSQL_SEARCH), dict(
+                text=text, phrase=fulltext.phrase(text, 'mysql'), limit=limit)).fetchall()
+        else:
+            rows = db.session.execute(db.text(fulltext.SQLITE_SEARCH), dict(
+                phrase=fulltext.phrase(text, 'sqlite'), limit=limit)).fetchall()
+        if not rows:
+            return []
+        videos = dict((video.id, video) for video in cls.query.filter(cls.id.in_([row[0] for row in rows])))
+        return [(videos[video_id], score) for video_id, score in rows if video_id in videos]
+
+
+class RollupState(Base):
+    __tablename__ = 'rollup_state'
+    '''汇总表已处理到的位置'''
+    name = db.Column(db.String(50), nullable=False, unique=True)  # 汇总表名
+    last_id = db.Column(db.BigInteger, nullable=False, default=0)  # 已汇总的最大id
+    seen_id = db.Column(db.BigInteger, nullable=False, default=0)  # 上次看到的最大id, lag秒后汇总到这里
+    seen_time = db.Column(db.DateTime)  # 看到seen_id的时间
+
+    @classmethod
+    def get(cls, name):
+        state = cls.query.filter_by(name=name).first()
+        if not state:
+            db.session.add(cls(name=name, last_id=0, seen_id=0))
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # created by another process at the same time
+                db.session.rollback()
+            state = cls.query.filter_by(name=name).first()
+        return state
+
+    @classmethod
+    def compare_and_set(cls, state, column, value, **values):
+        '''
+        set column to value only if no other process changed it since state was read
+        :param state: RollupState read in the current transaction
+        :param values: other columns to set
+        :return: False if another process changed it, the caller should roll back
+        '''
+        values[column] = value
+        return db.session.execute(cls.__table__.update().where(cls.id == state.id).where(
+            getattr(cls, column) == getattr(state, column)).values(**values)).rowcount == 1
+
+
+class VideoDailyCount(db.Model):
+    __tablename__ = 'video_daily_counts'
+    '''每天各任务、各网站的采集数量，由videoitems增量汇总'''
+    id = db.Column(db.Integer, primary_key=True)
+    task_id = db.Column(db.INTEGER, nullable=False, default=0)  # 作业实例ID, 0: 视频没有task_id
+    project_id = db.Column(db.INTEGER, nullable=False, default=0)  # 任务所属工程, 0: 任务不存在
+    site_name = db.Column(db.String(20), nullable=False, default='')
+    spider_type = db.Column(db.String(50), nullable=False, default='')  # 任务的采集形式
+    date = db.Column(db.Date, index=True)  # spider_time, 为空的视频只计入总数
+    count = db.Column(db.INTEGER, nullable=False, default=0)
+    __table_args__ = (
+        db.Index('ix_video_daily_counts_key', 'task_id', 'project_id', 'site_name', 'spider_type', 'date',
+                 unique=True),
+    )
+
+    @classmethod
+    def roll_up(cls, batch_size, lag=30):
+        '''
+        add the videos above the high water mark, one transaction per batch of ids
+        ids are committed out of order, so the mark only moves up to the max id seen at least lag seconds
+        before: a video whose insert was not committed lag seconds after a greater id was seen is never counted.
+        videos are never updated or deleted
+        processes running it at the same time move the state with compare and set, a batch whose state was
+        moved by another process is rolled back
+        :param batch_size: ids per transaction
+        :param lag: seconds an insert has to commit
+        :return: number of videos added
+        '''
+        state = RollupState.get(cls.__tablename__)
+        now = datetime.datetime.now()
+        if state.seen_time and state.seen_time > now - datetime.timedelta(seconds=lag):
+            db.session.commit()
+            return 0
+        limit = state.seen_id
+        max_id = db.session.query(db.func.max(Videoitems.id)).scalar() or 0
+        if not RollupState.compare_and_set(state, 'seen_id', max_id, seen_time=now):
+            db.session.rollback()
+            return 0
+        db.session.commit()
+        added = 0
+        while True:
+            state = RollupState.get(cls.__tablename__)
+            if state.last_id >= limit:
+                db.session.commit()
+                return added
+            upper = min(state.last_id + batch_size, limit)
+            if not RollupState.compare_and_set(state, 'last_id', upper):
+                db.session.rollback()
+                return added
+            rows = db.session.query(Videoitems.task_id, Videoitems.site_name, Videoitems.spider_time,
+                                    db.func.count(Videoitems.id)).filter(
+                Videoitems.id > state.last_id, Videoitems.id <= upper).group_by(
+                Videoitems.task_id, Videoitems.site_name, Videoitems.spider_time).all()
+            task_ids = set(task_id or 0 for task_id, _, _, _ in rows)
+            jobs = dict((job_id, (project_id, spider_type or '')) for job_id, project_id, spider_type in
+                        db.session.query(JobInstance.id, JobInstance.project_id, JobInstance.spider_type).filter(
+                            JobInstance.id.in_(task_ids)))
+            dates = list(set(spider_time for _, _, spider_time, _ in rows if spider_time))
+            daily_counts = dict(((daily_count.task_id, daily_count.project_id, daily_count.site_name,
+                                  daily_count.spider_type, daily_count.date), daily_count)
+                                for daily_count in cls.query.filter(
+                cls.task_id.in_(task_ids), db.or_(cls.date.in_(dates), cls.date == None) if dates else cls.date == None))
+            for task_id, site_name, spider_time, count in rows:
+                project_id, spider_type = jobs.get(task_id or 0, (0, ''))
+                key = (task_id or 0, project_id, site_name or '', spider_type, spider_time)
+                if key not in daily_counts:
+                    daily_counts[key] = cls(task_id=key[0], project_id=project_id, site_name=key[2],
+                                            spider_type=spider_type, date=spider_time, count=0)
+                    db.session.add(daily_counts[key])
+                daily_counts[key].count += count
+                added += count
+            db.session.commit()
 
 
 class RunningJob(Base):
@@ -305,6 +767,14 @@ class WebMonitor(db.Model):
     disconnect_num = db.Column(db.Integer, default=0)                        # 断开的次数
     disconnect_time = db.Column(db.DATETIME)                                 # 上一次断开的时间
 
+    @classmethod
+    def list_web_names(cls):
+        '''
+        site dropdown, cached until a monitored site changes
+        '''
+        return lookup_cache.get('web_names', lambda: [
+            web_name for web_name, in db.session.query(cls.web_name).order_by(cls.id)])
+
 
 class WebMonitorLog(db.Model):
     __tablename__ = 'target_web_monitor_log'
@@ -351,4 +821,94 @@ class User(db.Model):
         except BadSignature:
             return None  # invalid token
         user = User.query.get(data['id'])
-        return user
\ No newline at end of file
+        return user
+
+
+def _mark_lookup_dirty(key):
+    '''
+    flush events only record the changed lookup in session.info, the cache entry is dropped once the
+    transaction commits, a reload before the commit would cache the old rows again
+    '''
+
+    def mark(mapper, connection, target):
+        session = object_session(target)
+        if session is not None:
+            session.info.setdefault('dirty_lookups', set()).add(key)
+
+    return mark
+
+
+def _invalidate_dirty_lookups(session):
+    keys = session.info.pop('dirty_lookups', None)
+    if keys:
+        lookup_cache.invalidate(*keys)
+
+
+def _discard_dirty_lookups(session):
+    session.info.pop('dirty_lookups', None)
+
+
+def _update_job_video_counts(mapper, connection, target):
+    '''
+    the rolled up counts of a job follow its project and spider type
+    '''
+    attrs = inspect(target).attrs
+    if attrs.project_id.history.has_changes() or attrs.spider_type.history.has_changes():
+        connection.execute(VideoDailyCount.__table__.update().where(VideoDailyCount.task_id == target.id).values(
+            project_id=target.project_id, spider_type=target.spider_type or ''))
+
+
+def _delete_job_video_counts(mapper, connection, target):
+    connection.execute(VideoDailyCount.__table__.update().where(VideoDailyCount.task_id == target.id).values(
+        project_id=0, spider_type=''))
+
+
+for _event_name in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(JobInstance, _event_name, _mark_lookup_dirty('job_names'))
+    event.listen(WebMonitor, _event_name, _mark_lookup_dirty('web_names'))
+event.listen(db.session, 'after_commit', _invalidate_dirty_lookups)
+event.listen(db.session, 'after_rollback', _discard_dirty_lookups)
+event.listen(JobInstance, 'after_insert', _update_job_video_counts)
+event.listen(JobInstance, 'after_update', _update_job_video_counts)
+event.listen(JobInstance, 'after_delete', _delete_job_video_counts)
+
+
+# tables whose indexes were added after the table, create_all skips existing tables
+INDEXED_TABLES = [JobExecution.__table__]
+
+
+def list_missing_indexes(*tables):
+    '''
+    :return: [Index] declared on the tables but not in the database
+    '''
+    inspector = inspect(db.engine)
+    missing = []
+    for table in tables:
+        existing = set(index['name'] for index in inspector.get_indexes(table.name))
+        missing.extend(index for index in table.indexes if index.name not in existing)
+    return missing
+
+
+def check_indexes():
+    '''
+    warn about missing indexes at startup, they are built by python -m SpiderKeeper.create_indexes
+    '''
+    for index in list_missing_indexes(*INDEXED_TABLES):
+        app.logger.warning('index %s missing, run python -m SpiderKeeper.create_indexes' % index.name)
+
+
+def init_title_index():
+    '''
+    use the full text index of video titles if it was created, searches use LIKE otherwise
+    the index is built by python -m SpiderKeeper.create_title_index, it takes long on a large table
+    '''
+    dialect = db.engine.dialect.name
+    exists = {'mysql': fulltext.MYSQL_EXISTS, 'sqlite': fulltext.SQLITE_EXISTS}.get(dialect)
+    try:
+        if not exists or not db.engine.execute(exists).first():
+            app.logger.info('no full text index of video titles, title searches use LIKE')
+            return
+    except Exception as e:
+        app.logger.warning('full text index of video titles not available: %s' % str(e))
+        return
+    Videoitems.title_index = dialect
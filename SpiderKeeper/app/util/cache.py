@@ -0,0 +1,49 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    '''
+    in-process cache of small lookup tables, an entry is reloaded after ttl seconds or once invalidated
+    at most maxsize entries are kept, the least recently used one is dropped first
+    '''
+
+    def __init__(self, ttl=300, maxsize=1000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        '''
+        :param key:
+        :param loader: called without arguments to load the value on a miss
+        :return: cached value
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.time():
+                self._entries.move_to_end(key)
+                return entry[1]
+        value = loader()
+        with self._lock:
+            now = time.time()
+            self._entries.pop(key, None)
+            self._entries[key] = (now + self.ttl, value)
+            # entries are ordered by last use, drop the expired ones and then the oldest over maxsize
+            for old_key in [old_key for old_key, (expires, _) in self._entries.items() if expires <= now]:
+                del self._entries[old_key]
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, *keys):
+        '''
+        :param keys: entries to drop, all entries if none given
+        '''
+        with self._lock:
+            if not keys:
+                self._entries.clear()
+            for key in keys:
+                self._entries.pop(key, None)
@@ -23,6 +23,53 @@ def ts2dts(timeStamp):
     return datestr
 
 
+DATE_FORMAT = '%Y-%m-%d'
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+DATETIME_FORMATS = [DATETIME_FORMAT, '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d', '%Y/%m/%d %H:%M:%S', '%Y/%m/%d']
+
+
+def parse_date(value):
+    """
+    date of a request argument or a stored string like 2018-08-01 / 2018-08-01 12:00:00
+    :param value:
+    :return: datetime.date, None if it is not a date
+    """
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    try:
+        return datetime.datetime.strptime(value.strip()[:10], DATE_FORMAT).date()
+    except (AttributeError, ValueError):
+        return None
+
+
+def parse_datetime(value):
+    """
+    :param value: string in one of DATETIME_FORMATS or a unix timestamp
+    :return: datetime.datetime, None if it can not be parsed
+    """
+    if isinstance(value, datetime.datetime):
+        return value
+    value = str(value).strip() if value is not None else ''
+    if value.isdigit() and len(value) >= 9:
+        return datetime.datetime.fromtimestamp(int(value[:10]))
+    for fmt in DATETIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    return None
+
+
+def format_date(value):
+    return value.strftime(DATE_FORMAT) if value else None
+
+
+def format_datetime(value):
+    return value.strftime(DATETIME_FORMAT) if value else None
+
+
 if __name__ == '__main__':
     ee = ts2dts(1534052846)
     aa = datetime.datetime.utcnow()
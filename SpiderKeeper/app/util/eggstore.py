@@ -0,0 +1,37 @@
+import hashlib
+import os
+import shutil
+
+
+def egg_hash(file_path, chunk_size=64 * 1024):
+    '''
+    :param file_path:
+    :return: sha256 hex digest of the file, read in chunks
+    '''
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def egg_path(store_dir, hash_value):
+    return os.path.join(store_dir, '%s.egg' % hash_value)
+
+
+def store_egg(store_dir, file_path):
+    '''
+    move an egg into the content addressed store, an identical egg is stored once
+    :param store_dir:
+    :param file_path: uploaded egg, removed or moved into the store
+    :return: (hash, path in the store)
+    '''
+    hash_value = egg_hash(file_path)
+    dst = egg_path(store_dir, hash_value)
+    if os.path.exists(dst):
+        os.remove(file_path)
+    else:
+        if not os.path.isdir(store_dir):
+            os.makedirs(store_dir)
+        shutil.move(file_path, dst)
+    return hash_value, dst
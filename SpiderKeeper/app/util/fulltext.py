@@ -0,0 +1,54 @@
+'''
+full text index of video titles (videoitems.title, videoitems.title_cn)
+MySQL: FULLTEXT index with the ngram parser, chinese titles have no spaces to split words on
+SQLite: external content FTS5 table with the trigram tokenizer, kept in sync by triggers
+'''
+
+MYSQL_INDEX = 'ft_videoitems_title'
+SQLITE_TABLE = 'videoitems_fts'
+
+# shortest text the index can answer, shorter searches fall back to LIKE
+# mysql ngram_token_size defaults to 2, the trigram tokenizer needs 3 characters
+MIN_QUERY_LENGTH = {'mysql': 2, 'sqlite': 3}
+
+# one row if the index was created, by python -m SpiderKeeper.create_title_index
+MYSQL_EXISTS = "SHOW INDEX FROM videoitems WHERE Key_name = '%s'" % MYSQL_INDEX
+SQLITE_EXISTS = "SELECT name FROM sqlite_master WHERE type = 'table' AND name = '%s'" % SQLITE_TABLE
+
+MYSQL_DDL = 'ALTER TABLE videoitems ADD FULLTEXT INDEX %s (title, title_cn) WITH PARSER ngram' % MYSQL_INDEX
+
+SQLITE_DDL = [
+    "CREATE VIRTUAL TABLE {0} USING fts5(title, title_cn, content='videoitems', content_rowid='id', "
+    "tokenize='trigram')",
+    "CREATE TRIGGER {0}_ai AFTER INSERT ON videoitems BEGIN "
+    "INSERT INTO {0}(rowid, title, title_cn) VALUES (new.id, new.title, new.title_cn); END",
+    "CREATE TRIGGER {0}_ad AFTER DELETE ON videoitems BEGIN "
+    "INSERT INTO {0}({0}, rowid, title, title_cn) VALUES ('delete', old.id, old.title, old.title_cn); END",
+    "CREATE TRIGGER {0}_au AFTER UPDATE OF title, title_cn ON videoitems BEGIN "
+    "INSERT INTO {0}({0}, rowid, title, title_cn) VALUES ('delete', old.id, old.title, old.title_cn); "
+    "INSERT INTO {0}(rowid, title, title_cn) VALUES (new.id, new.title, new.title_cn); END",
+    # index the rows that existed before the table
+    "INSERT INTO {0}({0}) VALUES ('rebuild')",
+]
+SQLITE_DDL = [statement.format(SQLITE_TABLE) for statement in SQLITE_DDL]
+
+# ids of matching videos with a score, higher is better
+MYSQL_SEARCH = ('SELECT id, MATCH (title, title_cn) AGAINST (:text IN NATURAL LANGUAGE MODE) AS score '
+                'FROM videoitems WHERE MATCH (title, title_cn) AGAINST (:phrase IN BOOLEAN MODE) '
+                'ORDER BY score DESC LIMIT :limit')
+SQLITE_SEARCH = ('SELECT rowid AS id, -bm25({0}) AS score FROM {0} WHERE {0} MATCH :phrase '
+                 'ORDER BY score DESC LIMIT :limit').format(SQLITE_TABLE)
+
+# ids of all matching videos, used as a filter
+MYSQL_MATCH = 'MATCH (videoitems.title, videoitems.title_cn) AGAINST (:title_phrase IN BOOLEAN MODE)'
+SQLITE_MATCH = 'SELECT rowid FROM {0} WHERE {0} MATCH :title_phrase'.format(SQLITE_TABLE)
+
+
+def phrase(text, dialect):
+    '''
+    quote the text as one phrase, so operators typed by users are matched literally
+    '''
+    if dialect == 'mysql':
+        # boolean mode has no escape for a quote inside a phrase
+        return '"%s"' % text.replace('"', ' ')
+    return '"%s"' % text.replace('"', '""')
@@ -1,6 +1,264 @@
+import io
 import logging
+import os
+import random
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
 
 import requests
+from requests.adapters import HTTPAdapter
+
+# client settings, overridden from the app config by configure_clients
+_client_settings = dict(connect_timeout=5, read_timeout=30, pool_maxsize=16,
+                        failure_threshold=3, backoff_base=5, backoff_max=300)
+# one client per scheme://host:port
+_clients = {}
+_clients_lock = threading.Lock()
+
+# delay between retries: random in [0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** attempt)]
+RETRY_BACKOFF_BASE = 0.1
+RETRY_BACKOFF_MAX = 2
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    '''
+    closed: requests pass, failure_threshold consecutive failures open the circuit
+    open: requests fail fast until a jittered backoff, doubled on every trip, expires
+    half open: a single probe request closes the circuit or opens it again
+    '''
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, failure_threshold, backoff_base, backoff_max):
+        self.failure_threshold = failure_threshold
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.open_until = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def available(self):
+        '''
+        whether a request would be let through right now
+        '''
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return time.time() >= self.open_until
+        return not self._probing
+
+    def allow_request(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.time() < self.open_until:
+                    return False
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.trips = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.trips += 1
+                backoff = min(self.backoff_max, self.backoff_base * 2 ** (self.trips - 1))
+                self.open_until = time.time() + random.uniform(backoff / 2.0, backoff)
+                self.state = self.OPEN
+                self._probing = False
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'trips': self.trips,
+            'retry_in': max(int(self.open_until - time.time()), 0) if self.state == self.OPEN else 0,
+        }
+
+
+class HttpClient(object):
+    '''
+    keep-alive connection pool of one host with timeouts, a circuit breaker and request counters
+    '''
+
+    def __init__(self, base_url, connect_timeout, read_timeout, pool_maxsize,
+                 failure_threshold, backoff_base, backoff_max):
+        self.base_url = base_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_maxsize = pool_maxsize
+        self.breaker = CircuitBreaker(failure_threshold, backoff_base, backoff_max)
+        self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        self.session = requests.Session()
+        self.session.mount('http://', self._adapter)
+        self.session.mount('https://', self._adapter)
+        self._lock = threading.Lock()
+        self.request_count = 0
+        self.error_count = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def request(self, method, url, **kwargs):
+        '''
+        :param method: get/post
+        :param url:
+        :param kwargs: requests arguments, timeout defaults to the client timeout
+        :return: response obj
+        '''
+        if not self.breaker.allow_request():
+            raise CircuitOpenError('circuit open for %s' % self.base_url)
+        kwargs.setdefault('timeout', self.timeout)
+        start = time.time()
+        try:
+            res = self.session.request(method, url, **kwargs)
+        except Exception:
+            self.record(time.time() - start, error=True)
+            self.breaker.record_failure()
+            raise
+        self.record(time.time() - start)
+        if res.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return res
+
+    def record(self, latency, error=False):
+        with self._lock:
+            self.request_count += 1
+            self.error_count += 1 if error else 0
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def stats(self):
+        '''
+        :return: request counters, connection reuse and latency in ms
+        '''
+        connections, pool_requests = 0, 0
+        pools = self._adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool:
+                connections += pool.num_connections
+                pool_requests += pool.num_requests
+        with self._lock:
+            return {
+                'requests': self.request_count,
+                'errors': self.error_count,
+                'connections': connections,
+                'reused_connections': max(pool_requests - connections, 0),
+                'avg_latency_ms': int(self.total_latency * 1000 / self.request_count) if self.request_count else 0,
+                'max_latency_ms': int(self.max_latency * 1000),
+                'circuit': self.breaker.stats(),
+            }
+
+
+class MultipartFileStream(object):
+    '''
+    multipart/form-data body with one file part, the file is read from disk in chunks while sending
+    so requests streams it with a Content-Length and never holds the whole file in memory
+    '''
+    chunk_size = 64 * 1024
+
+    def __init__(self, fields, file_field, file_path):
+        boundary = uuid.uuid4().hex
+        head = ''.join('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n' % (boundary, name, value)
+                       for name, value in fields.items())
+        head += '--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n' \
+                'Content-Type: application/octet-stream\r\n\r\n' % (boundary, file_field, os.path.basename(file_path))
+        tail = '\r\n--%s--\r\n' % boundary
+        head, tail = head.encode('utf8'), tail.encode('utf8')
+        self.content_type = 'multipart/form-data; boundary=%s' % boundary
+        self._length = len(head) + os.path.getsize(file_path) + len(tail)
+        self._file = open(file_path, 'rb')
+        self._parts = [io.BytesIO(head), self._file, io.BytesIO(tail)]
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        chunks = []
+        while self._parts and size != 0:
+            chunk = self._parts[0].read(size)
+            if not chunk or size < 0:
+                self._parts.pop(0)
+            chunks.append(chunk)
+            size -= len(chunk) if size > 0 else 0
+        return b''.join(chunks)
+
+    def __iter__(self):
+        chunk = self.read(self.chunk_size)
+        while chunk:
+            yield chunk
+            chunk = self.read(self.chunk_size)
+
+    def close(self):
+        self._file.close()
+
+
+def configure_clients(connect_timeout=None, read_timeout=None, pool_maxsize=None,
+                      failure_threshold=None, backoff_base=None, backoff_max=None):
+    '''
+    change client settings, clients are rebuilt on next use
+    '''
+    settings = dict(connect_timeout=connect_timeout, read_timeout=read_timeout, pool_maxsize=pool_maxsize,
+                    failure_threshold=failure_threshold, backoff_base=backoff_base, backoff_max=backoff_max)
+    with _clients_lock:
+        _client_settings.update((key, value) for key, value in settings.items() if value is not None)
+        _clients.clear()
+
+
+def get_client(url):
+    '''
+    :param url:
+    :return: HttpClient shared by every request to the url's host
+    '''
+    parts = urlsplit(url)
+    base_url = '%s://%s' % (parts.scheme, parts.netloc)
+    client = _clients.get(base_url)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(base_url)
+            if client is None:
+                client = _clients[base_url] = HttpClient(base_url, **_client_settings)
+    return client
+
+
+def is_available(url):
+    '''
+    :param url:
+    :return: False while the circuit of the url's host is open
+    '''
+    return get_client(url).breaker.available
+
+
+def _retry_backoff(attempt):
+    time.sleep(random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** attempt)))
+
+
+def client_stats():
+    '''
+    :return: {base_url: stats}
+    '''
+    return dict((base_url, client.stats()) for base_url, client in list(_clients.items()))
 
 
 def request_get(url, retry_times=5):
@@ -10,8 +268,13 @@ def request_get(url, retry_times=5):
     :return: response obj
     '''
     for i in range(retry_times):
+        if i:
+            _retry_backoff(i - 1)
         try:
-            res = requests.get(url)
+            res = get_client(url).request('get', url)
+        except CircuitOpenError as e:
+            logging.warning('request skipped %s' % str(e))
+            return None
         except Exception as e:
             logging.warning('request error retry %s' % url)
             continue
@@ -20,16 +283,26 @@ def request_get(url, retry_times=5):
 
 def request_post(url, data, retry_times=5):
     '''
+    retried only when the connection failed, a post that reached the daemon, e.g. schedule.json
+    timing out while reading the answer, may have run and is never sent again
     :param url:
     :param retry_times:
     :return: response obj
     '''
     for i in range(retry_times):
+        if i:
+            _retry_backoff(i - 1)
         try:
-            res = requests.post(url, data)
-        except Exception as e:
+            res = get_client(url).request('post', url, data=data)
+        except CircuitOpenError as e:
+            logging.warning('request skipped %s' % str(e))
+            return None
+        except requests.ConnectionError as e:
             logging.warning('request error retry %s' % url)
             continue
+        except Exception as e:
+            logging.warning('request error %s %s' % (url, str(e)))
+            return None
         return res
 
 
@@ -0,0 +1,208 @@
+import mmap
+import os
+import re
+import struct
+import zlib
+
+# raw bytes per compressed block, blocks are cut at line ends
+BLOCK_SIZE = 64 * 1024
+
+# <name>.idx: header, one entry per line, one entry per block
+# header: magic, line count, block count, offset of the block entries
+# line: block number, offset of the line in the uncompressed block
+# block: offset in <name>.logz, compressed length, uncompressed length, number of its first line
+MAGIC = b'SKLOG001'
+_HEADER = struct.Struct('<8sQQQ')
+_LINE = struct.Struct('<II')
+_BLOCK = struct.Struct('<QIIQ')
+
+
+def log_paths(store_dir, name):
+    '''
+    :return: (compressed log path, index path)
+    '''
+    return os.path.join(store_dir, '%s.logz' % name), os.path.join(store_dir, '%s.idx' % name)
+
+
+class _LogWriter(object):
+    def __init__(self, data_file, idx_file, block_size):
+        self.data_file = data_file
+        self.idx_file = idx_file
+        self.block_size = block_size
+        self.blocks = []
+        self.line_count = 0
+        self.size = 0
+        self.idx_file.write(_HEADER.pack(MAGIC, 0, 0, 0))
+
+    def write_block(self, block):
+        block_no = len(self.blocks)
+        line_offsets = []
+        pos = 0
+        while pos < len(block):
+            line_offsets.append(pos)
+            pos = block.find(b'\n', pos) + 1 or len(block)
+        self.idx_file.write(b''.join(_LINE.pack(block_no, line_offset) for line_offset in line_offsets))
+        compressed = zlib.compress(bytes(block))
+        self.blocks.append((self.data_file.tell(), len(compressed), len(block), self.line_count))
+        self.data_file.write(compressed)
+        self.line_count += len(line_offsets)
+        self.size += len(block)
+
+    def write(self, chunks):
+        buf = bytearray()
+        for chunk in chunks:
+            buf += chunk
+            while len(buf) >= self.block_size:
+                # a line longer than a block gets a block of its own
+                cut = buf.rfind(b'\n', 0, self.block_size) + 1 or buf.find(b'\n', self.block_size) + 1
+                if not cut:
+                    break
+                self.write_block(buf[:cut])
+                del buf[:cut]
+        if buf:
+            self.write_block(buf)
+
+    def close(self):
+        block_table_offset = self.idx_file.tell()
+        self.idx_file.write(b''.join(_BLOCK.pack(*block) for block in self.blocks))
+        self.idx_file.seek(0)
+        self.idx_file.write(_HEADER.pack(MAGIC, self.line_count, len(self.blocks), block_table_offset))
+
+
+def write_log(store_dir, name, chunks, block_size=BLOCK_SIZE):
+    '''
+    store a log as independently compressed blocks with a line index, the log is never held in memory as a whole
+    :param store_dir:
+    :param name: file name without extension, e.g. the job execution id
+    :param chunks: iterable of bytes, an exception raised by it leaves no files behind
+    :param block_size:
+    :return: (size, line_count) of the uncompressed log
+    '''
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    data_path, idx_path = log_paths(store_dir, name)
+    # every process may mirror the same log at once, each writes its own files and the last rename wins
+    data_tmp, idx_tmp = ['%s.%s.tmp' % (path, os.getpid()) for path in (data_path, idx_path)]
+    try:
+        with open(data_tmp, 'wb') as data_file, open(idx_tmp, 'wb') as idx_file:
+            writer = _LogWriter(data_file, idx_file, block_size)
+            writer.write(chunks)
+            writer.close()
+        os.replace(data_tmp, data_path)
+        os.replace(idx_tmp, idx_path)
+    except BaseException:
+        for path in (data_tmp, idx_tmp):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    return writer.size, writer.line_count
+
+
+class LogMirror(object):
+    '''
+    read access to a stored log, both files are memory mapped
+    a line is found from its fixed size index entry, only the blocks holding the wanted lines are decompressed
+    '''
+
+    def __init__(self, store_dir, name):
+        data_path, idx_path = log_paths(store_dir, name)
+        self._files = [open(idx_path, 'rb'), open(data_path, 'rb')]
+        self._idx = mmap.mmap(self._files[0].fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.line_count, self.block_count, self._block_table = _HEADER.unpack_from(self._idx)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError('not a log index %s' % idx_path)
+        # an empty log has an empty data file, which can not be mapped
+        self._data = mmap.mmap(self._files[1].fileno(), 0, access=mmap.ACCESS_READ) if self.block_count else b''
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._idx.close()
+        for f in self._files:
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _block(self, block_no):
+        '''
+        :return: (uncompressed block, number of its first line)
+        '''
+        offset, length, _, first_line = _BLOCK.unpack_from(self._idx, self._block_table + block_no * _BLOCK.size)
+        return zlib.decompress(self._data[offset:offset + length]), first_line
+
+    @staticmethod
+    def _split(block, pos=0):
+        lines = block[pos:].split(b'\n')
+        # the trailing newline of a block does not start another line
+        return lines[:-1] if block.endswith(b'\n') else lines
+
+    def read_lines(self, start, count):
+        '''
+        :param start: first line number, from 0
+        :param count: max lines
+        :return: [str]
+        '''
+        if start < 0 or start >= self.line_count or count <= 0:
+            return []
+        block_no, pos = _LINE.unpack_from(self._idx, _HEADER.size + start * _LINE.size)
+        lines = []
+        while len(lines) < count and block_no < self.block_count:
+            block, _ = self._block(block_no)
+            lines.extend(self._split(block, pos)[:count - len(lines)])
+            block_no, pos = block_no + 1, 0
+        return [line.decode('utf8', 'replace') for line in lines]
+
+    def search(self, pattern, regex=False, ignore_case=False, limit=100):
+        '''
+        search the raw bytes block by block, only matching lines are decoded
+        :param pattern: substring or regular expression
+        :param regex:
+        :param ignore_case:
+        :param limit: max matching lines
+        :return: [(line number, line)]
+        '''
+        pattern = pattern.encode('utf8')
+        if regex or ignore_case:
+            # ^ and $ match at every line, as in grep
+            matcher = re.compile(pattern if regex else re.escape(pattern),
+                                 re.MULTILINE | (re.IGNORECASE if ignore_case else 0))
+
+            def find(block, pos):
+                while True:
+                    match = matcher.search(block, pos)
+                    if not match or block.find(b'\n', match.start(), match.end()) < 0:
+                        return match.start() if match else -1
+                    # the match runs over a line end, search its first line alone
+                    line_end = block.find(b'\n', match.start())
+                    match = matcher.search(block, block.rfind(b'\n', 0, match.start()) + 1, line_end)
+                    if match:
+                        return match.start()
+                    pos = line_end + 1
+        else:
+            def find(block, pos):
+                return block.find(pattern, pos)
+
+        result = []
+        for block_no in range(self.block_count):
+            block, line_no = self._block(block_no)
+            pos = counted = 0
+            while len(result) < limit:
+                found = find(block, pos)
+                if found < 0:
+                    break
+                line_start = block.rfind(b'\n', 0, found) + 1
+                line_end = block.find(b'\n', found)
+                line_end = len(block) if line_end < 0 else line_end
+                line_no += block.count(b'\n', counted, line_start)
+                counted = line_start
+                result.append((line_no, block[line_start:line_end].decode('utf8', 'replace')))
+                # one hit per line
+                pos = line_end + 1
+            if len(result) >= limit:
+                break
+        return result
@@ -0,0 +1,64 @@
+import base64
+import json
+import math
+
+from sqlalchemy import and_, or_
+
+PER_PAGE = 10
+
+
+def encode_cursor(values):
+    '''
+    :param values: sort key values of the last row of a page, json serializable
+    :return: opaque cursor
+    '''
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    '''
+    :return: sort key values, None if the cursor is not valid
+    '''
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf8'))
+    except (ValueError, TypeError, UnicodeError):
+        return None
+    return values if isinstance(values, list) else None
+
+
+def _after(order_by, values):
+    '''
+    rows after the cursor, (a, b) > (x, y) is written as a > x or (a = x and b > y) with each column's direction
+    '''
+    clauses = []
+    for i, (column, descending) in enumerate(order_by):
+        equal = [previous == value for (previous, _), value in zip(order_by[:i], values[:i])]
+        clauses.append(and_(*(equal + [column < values[i] if descending else column > values[i]])))
+    return or_(*clauses)
+
+
+def paginate(query, order_by, cursor_values, cursor=None, page=1, per_page=PER_PAGE):
+    '''
+    keyset pagination, a page seeks to the cursor through the sort index so deep pages cost the same as the first
+    :param query: filtered query without order_by
+    :param order_by: [(column, descending)], the last column must be unique, e.g. the id
+    :param cursor_values: item -> [value of each order_by column]
+    :param cursor: next_cursor of the previous page
+    :param page: used when there is no cursor, pages after the first fall back to an offset
+    :param per_page:
+    :return: (items, next_cursor), next_cursor is None on the last page
+    '''
+    values = decode_cursor(cursor) if cursor else None
+    seek = values is not None and len(values) == len(order_by)
+    if seek:
+        query = query.filter(_after(order_by, values))
+    query = query.order_by(*[column.desc() if descending else column for column, descending in order_by])
+    if not seek and page > 1:
+        query = query.offset((page - 1) * per_page)
+    items = query.limit(per_page + 1).all()
+    next_cursor = encode_cursor(cursor_values(items[per_page - 1])) if len(items) > per_page else None
+    return items[:per_page], next_cursor
+
+
+def total_pages(total, per_page=PER_PAGE):
+    return int(math.ceil(total / float(per_page))) if total is not None else None
@@ -0,0 +1,55 @@
+import datetime
+import re
+
+STATS_MARKER = 'Dumping Scrapy stats:'
+
+_STAT_LINE = re.compile(r"^\s*\{?'([^']+)':\s*(.*?)[,}]*\s*$")
+_DATETIME = re.compile(r'^datetime\.datetime\(([\d,\s]+)(?:,\s*tzinfo=.*)?\)$')
+
+
+def _parse_value(value):
+    if re.match(r'^-?\d+$', value):
+        return int(value)
+    if re.match(r'^-?\d+\.\d*(e-?\d+)?$', value):
+        return float(value)
+    if len(value) > 1 and value[0] == value[-1] and value[0] in '\'"':
+        return value[1:-1]
+    match = _DATETIME.match(value)
+    if match:
+        return datetime.datetime(*[int(part) for part in match.group(1).split(',') if part.strip()])
+    return value
+
+
+def parse_stats(lines):
+    '''
+    parse the stats scrapy dumps when a spider closes
+    :param lines: log lines, the last dump found in them is used
+    :return: {stat name: value}, None if the lines hold no dump
+    '''
+    start = None
+    for i, line in enumerate(lines):
+        if STATS_MARKER in line:
+            start = i
+    if start is None:
+        return None
+    stats = {}
+    for line in lines[start + 1:]:
+        match = _STAT_LINE.match(line)
+        if not match:
+            break
+        stats[match.group(1)] = _parse_value(match.group(2))
+        if line.rstrip().endswith('}'):
+            break
+    return stats
+
+
+def elapsed_seconds(stats):
+    '''
+    :return: run time in seconds from the stats, None if unknown
+    '''
+    if isinstance(stats.get('elapsed_time_seconds'), (int, float)):
+        return float(stats['elapsed_time_seconds'])
+    start_time, finish_time = stats.get('start_time'), stats.get('finish_time')
+    if isinstance(start_time, datetime.datetime) and isinstance(finish_time, datetime.datetime):
+        return (finish_time - start_time).total_seconds()
+    return None
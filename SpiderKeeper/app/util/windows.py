@@ -0,0 +1,40 @@
+import datetime
+from itertools import accumulate
+
+
+class DailySums(object):
+    '''
+    prefix sums of daily counts over (first_day - 1, last_day], any window of whole days is a subtraction
+    '''
+
+    def __init__(self, daily_counts, first_day, last_day):
+        '''
+        :param daily_counts: iterable of (datetime.date, count), days outside the range are ignored
+        :param first_day:
+        :param last_day:
+        '''
+        self.first_day = first_day
+        days = [0] * ((last_day - first_day).days + 2)
+        for day, count in daily_counts:
+            i = (day - first_day).days + 1
+            if 0 < i < len(days):
+                days[i] += count
+        self.sums = list(accumulate(days))
+
+    def window(self, end_day, span_days):
+        '''
+        :return: total of the days in (end_day - span_days, end_day]
+        '''
+        end = (end_day - self.first_day).days + 1
+        return self.sums[end] - self.sums[max(end - span_days, 0)]
+
+    def series(self, end_day, span_days, steps):
+        '''
+        totals of steps consecutive windows ending on end_day, oldest first
+        :return: [(window end day, total)]
+        '''
+        result = []
+        for step in reversed(range(steps)):
+            day = end_day - datetime.timedelta(days=span_days * step)
+            result.append((day, self.window(day, span_days)))
+        return result
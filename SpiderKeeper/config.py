@@ -32,10 +32,61 @@ SECRET_KEY = "secret"
 # log
 LOG_LEVEL = 'INFO'
 
-# spider services
+# spider services, scrapyd or scrapyd-async (all daemons driven from one asyncio event loop)
 SERVER_TYPE = 'scrapyd'
 SERVERS = ['http://127.0.0.1:6800']
 
+# job status sync: interval in seconds and max concurrent listjobs requests per cycle
+SYNC_JOB_STATUS_INTERVAL = 5
+SYNC_JOB_STATUS_CONCURRENCY = 16
+# seconds after its end a finished job with no execution is no longer checked, e.g. a job started outside SpiderKeeper
+UNMATCHED_JOB_ACK_AGE = 300
+
+# max concurrent schedule.json requests when a job fans out over keywords
+DISPATCH_CONCURRENCY = 8
+
+# refresh interval in seconds of the daemon load used to choose where spiders run
+DAEMON_STATUS_INTERVAL = 10
+
+# deployed eggs kept by content hash, daemons missing the current egg of a project get it from here
+EGG_STORE_DIR = os.path.join(BASE_DIR, 'eggs')
+EGG_SYNC_INTERVAL = 60
+
+# job log viewer: KB shown from the end of a log, bytes read per page when paging forward
+LOG_TAIL_KB = 64
+LOG_PAGE_SIZE = 256 * 1024
+
+# logs of finished jobs are copied here, at most LOG_MIRROR_BATCH logs per run of the mirror job
+LOG_MIRROR_DIR = os.path.join(BASE_DIR, 'logs')
+LOG_MIRROR_INTERVAL = 60
+LOG_MIRROR_BATCH = 20
+
+# scrapy stats are read from the last lines of mirrored logs
+STATS_TAIL_LINES = 300
+
+# seconds the job and site dropdown lists are cached, they are also dropped when jobs or sites change
+LOOKUP_CACHE_TTL = 300
+
+# seconds a list api total count is cached for the same filters, and max filters cached per process
+PAGE_TOTAL_CACHE_TTL = 60
+PAGE_TOTAL_CACHE_SIZE = 1000
+
+# seconds between roll ups of new videoitems into video_daily_counts, and videos per roll up transaction
+VIDEO_ROLLUP_INTERVAL = 60
+VIDEO_ROLLUP_BATCH = 50000
+# seconds a videoitems insert has to commit before its id is rolled up, rows committed later are not counted
+VIDEO_ROLLUP_LAG = 30
+
+# http client of each daemon: timeouts in seconds and max keep-alive connections
+HTTP_CONNECT_TIMEOUT = 5
+HTTP_READ_TIMEOUT = 30
+HTTP_POOL_MAXSIZE = 16
+
+# circuit breaker of each daemon: consecutive failures before opening, backoff bounds in seconds
+CIRCUIT_FAILURE_THRESHOLD = 3
+CIRCUIT_BACKOFF_BASE = 5
+CIRCUIT_BACKOFF_MAX = 300
+
 # basic auth
 NO_AUTH = True
 BASIC_AUTH_USERNAME = 'admin'
@@ -0,0 +1,42 @@
+'''
+create the indexes declared on existing tables after they were created, db.create_all skips existing tables
+
+    python -m SpiderKeeper.create_indexes --database-url mysql://...
+
+creating an index on a large job_execution table takes long, run it once in a quiet hour, SpiderKeeper logs a
+warning at startup while an index is missing
+the indexes of videoitems are created by SpiderKeeper.migrate_videoitems, the title index by
+SpiderKeeper.create_title_index
+'''
+import logging
+from optparse import OptionParser
+
+from SpiderKeeper.app import app, db
+from SpiderKeeper.app.spider.model import INDEXED_TABLES, list_missing_indexes
+
+
+def main():
+    opts, args = parse_opts(app.config)
+    app.config.update(dict(SQLALCHEMY_DATABASE_URI=opts.database_url))
+    app.logger.setLevel(logging.INFO)
+    db.init_app(app)
+    with app.app_context():
+        missing = list_missing_indexes(*INDEXED_TABLES)
+        for index in missing:
+            app.logger.info('creating index %s' % index.name)
+            index.create(db.engine)
+        app.logger.info('%s indexes created' % len(missing))
+
+
+def parse_opts(config):
+    parser = OptionParser(usage="%prog [options]",
+                          description="create the indexes missing on existing tables")
+    parser.add_option("--database-url",
+                      help='SpiderKeeper metadata database default: %s' % config.get('SQLALCHEMY_DATABASE_URI'),
+                      dest='database_url',
+                      default=config.get('SQLALCHEMY_DATABASE_URI'))
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+'''
+create the full text index of video titles used by the video list and /api/videos/search
+
+    python -m SpiderKeeper.create_title_index --database-url mysql://...
+
+MySQL:  adds a FULLTEXT index with the ngram parser, the table is rebuilt and writes wait until it is done
+SQLite: creates the FTS5 table, its triggers and indexes the existing rows in one transaction
+run it once, in a quiet hour on a large table, then restart SpiderKeeper: the index is looked up at startup
+and title searches use LIKE until then
+'''
+import logging
+from optparse import OptionParser
+
+from SpiderKeeper.app import app, db
+from SpiderKeeper.app.util import fulltext
+
+
+def create(engine):
+    '''
+    :return: False if the index already exists
+    '''
+    dialect = engine.dialect.name
+    if dialect == 'mysql':
+        if engine.execute(fulltext.MYSQL_EXISTS).first():
+            return False
+        engine.execute(fulltext.MYSQL_DDL)
+    elif dialect == 'sqlite':
+        with engine.begin() as connection:
+            if connection.execute(fulltext.SQLITE_EXISTS).first():
+                return False
+            for statement in fulltext.SQLITE_DDL:
+                connection.execute(statement)
+    else:
+        raise ValueError('no full text index for %s' % dialect)
+    return True
+
+
+def main():
+    opts, args = parse_opts(app.config)
+    app.config.update(dict(SQLALCHEMY_DATABASE_URI=opts.database_url))
+    app.logger.setLevel(logging.INFO)
+    db.init_app(app)
+    with app.app_context():
+        app.logger.info('creating full text index of video titles')
+        if create(db.engine):
+            app.logger.info('full text index of video titles created')
+        else:
+            app.logger.info('full text index of video titles already exists')
+
+
+def parse_opts(config):
+    parser = OptionParser(usage="%prog [options]",
+                          description="create the full text index of video titles")
+    parser.add_option("--database-url",
+                      help='SpiderKeeper metadata database default: %s' % config.get('SQLALCHEMY_DATABASE_URI'),
+                      dest='database_url',
+                      default=config.get('SQLALCHEMY_DATABASE_URI'))
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
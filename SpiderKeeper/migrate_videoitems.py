@@ -0,0 +1,186 @@
+'''
+migrate videoitems.spider_time / upload_time / task_id from strings to DATE / DATETIME / INTEGER columns
+the table stays writable, spiders keep inserting while the rows are converted batch by batch
+
+    python -m SpiderKeeper.migrate_videoitems --database-url mysql://... add
+    python -m SpiderKeeper.migrate_videoitems --database-url mysql://... backfill
+    python -m SpiderKeeper.migrate_videoitems --database-url mysql://... swap
+    python -m SpiderKeeper.migrate_videoitems --database-url mysql://... drop
+
+add:      add the typed columns next to the string ones (<name>_new)
+backfill: convert the rows into the typed columns, can be stopped and resumed with --start-id
+swap:     convert the rows added after --start-id (the last id logged by backfill), rename the string columns
+          to <name>_str, the typed columns to <name> and create the indexes of Videoitems
+drop:     drop the <name>_str columns once the new columns are checked
+migrate:  add, backfill and swap
+
+upgrade order, the Videoitems model of the new code declares the typed columns and their indexes and
+db.create_all never alters an existing table:
+    1. with the old code still running: add and backfill, backfill can take hours on a large table
+    2. swap, the old code keeps inserting strings, MySQL converts them into the typed columns, keep the
+       time until step 3 short: a string it cannot convert fails the insert in strict mode
+    3. deploy and restart the new code, it must not run before swap: it would compare DATE values with
+       the string columns and scan the table without the indexes
+    4. drop, once the typed columns are checked
+a new database created by the new code is already typed, state prints typed and there is nothing to run
+'''
+import logging
+from optparse import OptionParser
+
+from sqlalchemy import inspect, text
+from sqlalchemy.sql import sqltypes
+
+from SpiderKeeper.app import app, db
+from SpiderKeeper.app.util.dates import parse_date, parse_datetime
+
+TABLE = 'videoitems'
+
+# (column, string type, typed type, converter of the string)
+COLUMNS = [
+    ('spider_time', 'VARCHAR(50)', 'DATE', parse_date),
+    ('upload_time', 'VARCHAR(50)', 'DATETIME', parse_datetime),
+    ('task_id', 'VARCHAR(20)', 'INTEGER', lambda value: int(value) if value and str(value).strip().isdigit() else None),
+]
+
+INDEXES = [
+    ('ix_videoitems_spider_time', 'spider_time'),
+    ('ix_videoitems_task_id_spider_time', 'task_id, spider_time'),
+    ('ix_videoitems_site_name_spider_time', 'site_name, spider_time'),
+]
+
+
+def state(engine):
+    '''
+    :return: initial / added / swapped / typed
+    '''
+    columns = dict((column['name'], column['type']) for column in inspect(engine).get_columns(TABLE))
+    if 'spider_time_str' in columns:
+        return 'swapped'
+    if 'spider_time_new' in columns:
+        return 'added'
+    if isinstance(columns['spider_time'], sqltypes.Date):
+        return 'typed'
+    return 'initial'
+
+
+def add(engine):
+    if state(engine) != 'initial':
+        return
+    with engine.begin() as connection:
+        for name, _, new_type, _ in COLUMNS:
+            connection.execute('ALTER TABLE %s ADD COLUMN %s_new %s' % (TABLE, name, new_type))
+    app.logger.info('typed columns added')
+
+
+def backfill(engine, source, target, start_id=0, batch_size=5000, only_null=False):
+    '''
+    convert rows with an id above start_id in batches, one transaction per batch
+    :param source: suffix of the string columns, '' or '_str'
+    :param target: suffix of the typed columns, '_new' or ''
+    :param only_null: skip rows already converted
+    :return: id of the last converted row
+    '''
+    names = [name for name, _, _, _ in COLUMNS]
+    select = text('SELECT id, %s FROM %s WHERE id > :last_id%s ORDER BY id LIMIT :batch_size' % (
+        ', '.join(name + source for name in names), TABLE,
+        ' AND %s%s IS NULL' % (names[0], target) if only_null else ''))
+    update = text('UPDATE %s SET %s WHERE id = :id' % (
+        TABLE, ', '.join('%s%s = :%s' % (name, target, name) for name in names)))
+    last_id = start_id
+    converted = 0
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(select, last_id=last_id, batch_size=batch_size).fetchall()
+            if not rows:
+                break
+            values = []
+            for row in rows:
+                value = dict(id=row[0])
+                for (name, _, _, convert), old in zip(COLUMNS, row[1:]):
+                    value[name] = convert(old) if old is not None else None
+                values.append(value)
+            connection.execute(update, values)
+        last_id = rows[-1][0]
+        converted += len(rows)
+        app.logger.info('converted %s rows, last id %s' % (converted, last_id))
+    return last_id
+
+
+def swap(engine, start_id=0, batch_size=5000):
+    if state(engine) != 'added':
+        return
+    last_id = backfill(engine, '', '_new', start_id=start_id, batch_size=batch_size, only_null=True)
+    with engine.begin() as connection:
+        if engine.dialect.name == 'mysql':
+            # one statement, readers never see the columns half renamed
+            clauses = []
+            for name, old_type, new_type, _ in COLUMNS:
+                clauses.append('CHANGE %s %s_str %s' % (name, name, old_type))
+                clauses.append('CHANGE %s_new %s %s' % (name, name, new_type))
+            clauses.extend('ADD INDEX %s (%s)' % index for index in INDEXES)
+            connection.execute('ALTER TABLE %s %s' % (TABLE, ', '.join(clauses)))
+        else:
+            for name, _, _, _ in COLUMNS:
+                connection.execute('ALTER TABLE %s RENAME COLUMN %s TO %s_str' % (TABLE, name, name))
+                connection.execute('ALTER TABLE %s RENAME COLUMN %s_new TO %s' % (TABLE, name, name))
+            for index in INDEXES:
+                connection.execute('CREATE INDEX %s ON %s (%s)' % (index[0], TABLE, index[1]))
+    # rows inserted between the last batch and the rename
+    backfill(engine, '_str', '', start_id=last_id, batch_size=batch_size, only_null=True)
+    app.logger.info('typed columns in use')
+
+
+def drop(engine):
+    if state(engine) != 'swapped':
+        return
+    with engine.begin() as connection:
+        for name, _, _, _ in COLUMNS:
+            connection.execute('ALTER TABLE %s DROP COLUMN %s_str' % (TABLE, name))
+    app.logger.info('string columns dropped')
+
+
+def main():
+    opts, args = parse_opts(app.config)
+    if len(args) != 1 or args[0] not in ('add', 'backfill', 'swap', 'drop', 'migrate', 'state'):
+        print(__doc__)
+        return
+    app.config.update(dict(SQLALCHEMY_DATABASE_URI=opts.database_url))
+    app.logger.setLevel(logging.INFO)
+    db.init_app(app)
+    with app.app_context():
+        engine = db.engine
+        command = args[0]
+        start_id = opts.start_id
+        if command in ('add', 'migrate'):
+            add(engine)
+        if command in ('backfill', 'migrate') and state(engine) == 'added':
+            start_id = backfill(engine, '', '_new', start_id=start_id, batch_size=opts.batch_size)
+        if command in ('swap', 'migrate'):
+            swap(engine, start_id=start_id, batch_size=opts.batch_size)
+        if command == 'drop':
+            drop(engine)
+        print(state(engine))
+
+
+def parse_opts(config):
+    parser = OptionParser(usage="%prog [options] add|backfill|swap|drop|migrate|state",
+                          description="convert videoitems to typed columns")
+    parser.add_option("--database-url",
+                      help='SpiderKeeper metadata database default: %s' % config.get('SQLALCHEMY_DATABASE_URI'),
+                      dest='database_url',
+                      default=config.get('SQLALCHEMY_DATABASE_URI'))
+    parser.add_option("--batch-size",
+                      help="rows per transaction, default: 5000",
+                      dest='batch_size',
+                      type="int",
+                      default=5000)
+    parser.add_option("--start-id",
+                      help="backfill / swap rows after this id, default: 0",
+                      dest='start_id',
+                      type="int",
+                      default=0)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main()
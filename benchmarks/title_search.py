@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+'''
+compare the LIKE scan of video titles with the SQLite FTS5 index used by VideosCtrl and VideoSearchCtrl
+
+    python benchmarks/title_search.py --rows 2000000
+
+the table and the index are built from SpiderKeeper/app/util/fulltext.py in a temporary sqlite file
+'''
+import argparse
+import importlib.util
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+# load the module by path, importing the SpiderKeeper.app package would start the whole app
+_spec = importlib.util.spec_from_file_location(
+    'fulltext', os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'SpiderKeeper', 'app', 'util',
+                             'fulltext.py'))
+fulltext = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(fulltext)
+
+CN_WORDS = ['新闻', '直播', '体育', '足球', '篮球', '电影', '音乐', '旅游', '美食', '科技', '财经', '教育', '游戏',
+            '汽车', '时尚', '纪录片', '综艺', '动画', '天气', '健康']
+EN_WORDS = ['news', 'live', 'sports', 'football', 'music', 'travel', 'food', 'tech', 'finance', 'game', 'cars',
+            'fashion', 'documentary', 'show', 'cartoon', 'weather', 'health', 'review', 'trailer', 'episode']
+# common words, a rare word pair, a number that few titles carry and a miss
+# the trigram tokenizer needs 3 characters, shorter searches use LIKE in the app
+QUERIES = ['纪录片', 'football', '足球直播', '美食旅游', 'tech 4242', '77777', 'zzzz']
+
+
+def make_title(rnd, words, sep):
+    return sep.join(rnd.choice(words) for _ in range(rnd.randint(3, 8))) + sep + str(rnd.randint(1, 99999))
+
+
+def build(path, rows, seed):
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE videoitems (id INTEGER PRIMARY KEY, title VARCHAR(500), title_cn VARCHAR(500))')
+    batch = 10000
+    for start in range(0, rows, batch):
+        conn.executemany('INSERT INTO videoitems (title, title_cn) VALUES (?, ?)', [
+            (make_title(rnd, EN_WORDS, ' '), make_title(rnd, CN_WORDS, ''))
+            for _ in range(min(batch, rows - start))])
+    conn.commit()
+    started = time.time()
+    for statement in fulltext.SQLITE_DDL:
+        conn.execute(statement)
+    conn.commit()
+    return conn, time.time() - started
+
+
+def timed(conn, sql, params, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.time()
+        rows = conn.execute(sql, params).fetchall()
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=2000000)
+    parser.add_argument('--limit', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        started = time.time()
+        conn, index_time = build(path, args.rows, args.seed)
+        print('%d rows loaded in %.1fs, index built in %.1fs' % (args.rows, time.time() - started - index_time,
+                                                                  index_time))
+        like_where = 'title LIKE :pattern OR title_cn LIKE :pattern'
+        match_where = 'id IN (%s)' % fulltext.SQLITE_MATCH
+        print('%-10s %9s %9s %9s %9s %9s %9s' % ('query', 'matches', 'like', 'match', 'ranked', 'like#', 'match#'))
+        for query in QUERIES:
+            like = dict(pattern='%' + query + '%', limit=args.limit)
+            match = dict(title_phrase=fulltext.phrase(query, 'sqlite'), limit=args.limit)
+            # first page of the video list, newest first
+            like_time, _ = timed(conn, 'SELECT id FROM videoitems WHERE %s ORDER BY id DESC LIMIT :limit'
+                                 % like_where, like, args.repeat)
+            match_time, _ = timed(conn, 'SELECT id FROM videoitems WHERE %s ORDER BY id DESC LIMIT :limit'
+                                  % match_where, match, args.repeat)
+            # VideoSearchCtrl, best matches first
+            ranked_time, _ = timed(conn, fulltext.SQLITE_SEARCH, dict(phrase=match['title_phrase'],
+                                                                     limit=args.limit), args.repeat)
+            # total of the video list
+            like_count_time, _ = timed(conn, 'SELECT count(*) FROM videoitems WHERE %s' % like_where, like,
+                                       args.repeat)
+            match_count_time, _ = timed(conn, 'SELECT count(*) FROM videoitems WHERE %s' % match_where, match,
+                                        args.repeat)
+            total = conn.execute('SELECT count(*) FROM videoitems WHERE %s' % like_where, like).fetchone()[0]
+            print('%-10s %9d %9.1f %9.1f %9.1f %9.1f %9.1f' % (
+                query, total, like_time * 1000, match_time * 1000, ranked_time * 1000, like_count_time * 1000,
+                match_count_time * 1000))
+        print('times in ms, best of %d' % args.repeat)
+        conn.close()
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
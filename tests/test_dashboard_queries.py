@@ -0,0 +1,104 @@
+'''
+the job dashboards must run a fixed number of queries, whatever the number of jobs and executions
+
+    python -m pytest tests
+'''
+import datetime
+
+import pytest
+from sqlalchemy import event
+
+from SpiderKeeper.app import app, db
+from SpiderKeeper.app.spider.controller import total_cache
+from SpiderKeeper.app.spider.model import Project, JobInstance, JobExecution, SpiderStatus, User, lookup_cache
+
+STATUSES = [SpiderStatus.PENDING, SpiderStatus.RUNNING, SpiderStatus.FINISHED, SpiderStatus.CANCELED]
+
+
+@pytest.fixture
+def database(tmpdir):
+    '''
+    :return: function filling a new sqlite database with jobs, returns an api token
+    '''
+    context = app.app_context()
+    context.push()
+
+    def create(jobs):
+        db.session.remove()
+        db.get_engine(app).dispose()
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + str(tmpdir.join('jobs%s.db' % jobs))
+        db.create_all()
+        token = add_jobs(jobs)
+        lookup_cache.invalidate()
+        total_cache.invalidate()
+        return token
+
+    yield create
+    db.session.remove()
+    db.get_engine(app).dispose()
+    context.pop()
+
+
+def add_jobs(count):
+    '''
+    count jobs with one execution in each state
+    :return: api token
+    '''
+    project = Project()
+    project.project_name = 'project'
+    user = User(user_name='user', confirmed=True)
+    db.session.add_all([project, user])
+    db.session.commit()
+    now = datetime.datetime.now()
+    for i in range(count):
+        job_instance = JobInstance(project_id=project.id, spider_name='spider%s' % i, job_name='job%s' % i,
+                                   run_type='onetime', enabled=0)
+        db.session.add(job_instance)
+        db.session.flush()
+        for status in STATUSES:
+            db.session.add(JobExecution(project_id=project.id, job_instance_id=job_instance.id,
+                                        service_job_execution_id='%s-%s' % (i, status), running_on='daemon',
+                                        create_time=now, start_time=now, running_status=status))
+    db.session.commit()
+    return user.generate_auth_token().decode()
+
+
+def count_queries(run):
+    '''
+    :param run: called without arguments
+    :return: result of run, statements sent to the database meanwhile
+    '''
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    engine = db.get_engine(app)
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        return run(), len(statements)
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+@pytest.mark.parametrize('url', [
+    '/project/1/job/dashboard',
+    '/api/job_executions/1',
+])
+def test_render_queries_do_not_grow_with_jobs(database, url):
+    counts = []
+    for jobs in (1, 20):
+        token = database(jobs)
+        response, queries = count_queries(lambda: app.test_client().get(url, headers={'username_or_token': token}))
+        assert response.status_code == 200
+        counts.append(queries)
+    assert counts[0] == counts[1], 'queries per render grew from %s to %s' % tuple(counts)
+
+
+def test_list_jobs_loads_job_instances_with_executions(database):
+    database(20)
+    job_status, queries = count_queries(lambda: JobExecution.list_jobs(1))
+    # one query per state, the job instances are joined in
+    assert queries == 3
+    assert len(job_status['PENDING']) == 20 and len(job_status['COMPLETED']) == 40
+    assert all(execution['job_instance']['job_name'] for execution in job_status['RUNNING'])